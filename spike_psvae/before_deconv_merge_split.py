@@ -1,13 +1,17 @@
 import numpy as np
 import h5py
 import multiprocessing
+import numba
+import queue
+import threading
+from collections import OrderedDict
 
 
 try:
     from isosplit import isosplit
 except ImportError:
     pass
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import wraps
 from hdbscan import HDBSCAN
 from hdbscan.robust_single_linkage_ import RobustSingleLinkage
@@ -20,7 +24,6 @@ from sklearn.cluster import OPTICS, MeanShift
 from tqdm.auto import tqdm
 
 from .multiprocessing_utils import MockPoolExecutor
-from .waveform_utils import get_channel_subset
 from .isocut5 import isocut5, isosplit1d
 from .chunk_features import TPCA
 from .snr_templates import get_raw_template_single
@@ -47,17 +50,28 @@ class H5Extractor:
         log_c=5,
         feature_scales=(1, 1, 50),
         waveforms_kind="cleaned",
+        h5_cache_nbytes=512 * 1024 * 1024,
+        max_tpca_in_memory_nbytes=2 * 1024 * 1024 * 1024,
+        template_cache_size=256,
     ):
         self.raw_data_bin = raw_data_bin
 
         # get the clustering features in memory
-        h5 = h5py.File(h5_path)
+        # we keep the file open for the lifetime of the worker, with a
+        # large chunk cache so that tpca_projs chunks shared by several
+        # units are only read from disk once
+        self.h5 = h5 = open_h5_with_cache(h5_path, h5_cache_nbytes)
         self.x = x = h5["localizations"][:, 0]
         self.z = z = h5["z_reg"][:]
         self.maxptp = maxptp = h5["maxptps"][:]
         self.spike_times, self.max_channels = h5["spike_index"][:].T
         self.channel_index = h5["channel_index"][:]
         self.n_channels = self.channel_index.shape[0]
+        # position of each channel in its own channel neighborhood
+        ix0, self.rel_max_channels = np.nonzero(
+            self.channel_index == np.arange(self.n_channels)[:, None]
+        )
+        assert np.array_equal(ix0, np.arange(self.n_channels))
         self.features = np.c_[x, z, np.log(log_c + maxptp)]
         self.features *= feature_scales
         self.geom = h5["geom"][:]
@@ -67,9 +81,10 @@ class H5Extractor:
         self.log_c = log_c
         self.feature_scales = feature_scales
 
-        # refrence to waveform tpca embeddings in h5 file
-        # we could load them in memory here if that seems helpful
-        self.tpca_projs = h5[f"{waveforms_kind}_tpca_projs"]
+        # waveform tpca embeddings, in memory if they fit
+        self.tpca_projs = load_tpca_projs(
+            h5, waveforms_kind, max_tpca_in_memory_nbytes
+        )
 
         # load sklearn PCA object from the h5 so that split steps can
         # reconstruct waveforms from the tpca projections
@@ -82,6 +97,44 @@ class H5Extractor:
         self.tpca = tpca_feat
         self.T = tpca_feat.T
 
+        # least recently used cache of raw templates, so that split
+        # steps which see the same unit don't re-read the raw data
+        self.template_cache = OrderedDict()
+        self.template_cache_size = template_cache_size
+        # split steps may share the extractor across threads
+        self.template_cache_lock = threading.Lock()
+        self.rel_sub_channel_index_cache = {}
+
+    def get_raw_template(self, in_unit):
+        key = (in_unit.size, hash(in_unit.tobytes()))
+        with self.template_cache_lock:
+            if key in self.template_cache:
+                self.template_cache.move_to_end(key)
+                return self.template_cache[key]
+
+        template = get_raw_template_single(
+            self.spike_times[in_unit],
+            self.raw_data_bin,
+            self.n_channels,
+        )
+        with self.template_cache_lock:
+            self.template_cache[key] = template
+            if len(self.template_cache) > self.template_cache_size:
+                self.template_cache.popitem(last=False)
+
+        return template
+
+    def get_rel_sub_channel_index(self, which_chans):
+        # units with the same channel subset share this. with the
+        # "distance" chans_method, that is all units with the same
+        # template max channel, so this cache stays small
+        key = which_chans.tobytes()
+        if key not in self.rel_sub_channel_index_cache:
+            self.rel_sub_channel_index_cache[key] = get_rel_sub_channel_index(
+                self.channel_index, which_chans
+            )
+        return self.rel_sub_channel_index_cache[key]
+
 
 def herding_split(
     in_unit,
@@ -115,11 +168,7 @@ def herding_split(
     new_labels = np.zeros(in_unit.shape, dtype=int)
 
     # pick the subset of channels to use
-    template = get_raw_template_single(
-        extractor.spike_times[in_unit],
-        extractor.raw_data_bin,
-        extractor.n_channels,
-    )
+    template = extractor.get_raw_template(in_unit)
     if chans_method == "amplitude":
         which_chans = (-template.ptp(0)).argsort()[:chans_amplitude_n_channels]
     elif chans_method == "distance":
@@ -149,19 +198,23 @@ def herding_split(
             extractor.geom,
             T=extractor.T,
         )
+        too_far = np.isnan(unit_features).any(axis=(1, 2))
+        unit_features = unit_features[~too_far]
     else:
-        unit_features = get_pca_projs_on_channel_subset(
+        unit_features, too_far = get_pca_projs_on_channel_subset(
             in_unit,
             extractor.tpca_projs,
             extractor.max_channels,
             extractor.channel_index,
             which_chans,
+            rel_sub_channel_index=extractor.get_rel_sub_channel_index(
+                which_chans
+            ),
         )
 
     # some spikes may not exist on all these channels.
     # this should be exceedingly rare but everything that can
     # happen will. for now, let's triage them away
-    too_far = np.isnan(unit_features).any(axis=(1, 2))
     new_labels[too_far] = -1
     kept = np.flatnonzero(new_labels >= 0)
 
@@ -170,9 +223,9 @@ def herding_split(
         return False, None, None
 
     # fit a pca projection to what we got
-    pca_projs = PCA(n_pca_features, whiten=True).fit_transform(
-        unit_features[kept].reshape(kept.size, -1)
-    )
+    pca_projs = PCA(
+        n_pca_features, whiten=True, svd_solver="randomized", random_state=0
+    ).fit_transform(unit_features.reshape(kept.size, -1))
     del unit_features
 
     # create features for hdbscan, scaling pca projs to match
@@ -241,7 +294,7 @@ def herding_split(
     else:
         raise ValueError(f"{clusterer=} not understood.")
 
-    is_split = np.setdiff1d(np.unique(new_labels), [-1]).size > 1
+    is_split = has_multiple_labels(new_labels)
     return is_split, new_labels, in_unit
 
 
@@ -265,18 +318,14 @@ def maxchan_lda_split(
     # this step relies on there being multiple max channels
     # so let's bail if this is not the case
     unit_max_chans = extractor.max_channels[in_unit]
-    if np.unique(unit_max_chans).size <= 1:
+    if not has_multiple_labels(unit_max_chans):
         return False, None, None
 
     # we'll store new labels here, including -1 for triage
     new_labels = np.zeros(in_unit.shape, dtype=int)
 
     # pick the subset of channels to use
-    template = get_raw_template_single(
-        extractor.spike_times[in_unit],
-        extractor.raw_data_bin,
-        extractor.n_channels,
-    )
+    template = extractor.get_raw_template(in_unit)
     if chans_method == "amplitude":
         which_chans = (-template.ptp(0)).argsort()[:n_channels]
     elif chans_method == "distance":
@@ -306,19 +355,23 @@ def maxchan_lda_split(
             extractor.geom,
             T=extractor.T,
         )
+        too_far = np.isnan(unit_features).any(axis=(1, 2))
+        unit_features = unit_features[~too_far]
     else:
-        unit_features = get_pca_projs_on_channel_subset(
+        unit_features, too_far = get_pca_projs_on_channel_subset(
             in_unit,
             extractor.tpca_projs,
             extractor.max_channels,
             extractor.channel_index,
             which_chans,
+            rel_sub_channel_index=extractor.get_rel_sub_channel_index(
+                which_chans
+            ),
         )
 
     # some spikes may not exist on all these channels.
     # this should be exceedingly rare but everything that can
     # happen will. for now, let's triage them away
-    too_far = np.isnan(unit_features).any(axis=(1, 2))
     new_labels[too_far] = -1
     kept = np.flatnonzero(new_labels >= 0)
 
@@ -332,7 +385,7 @@ def maxchan_lda_split(
     # fit the lda model
     n_lda_components = min(n_max_chans - 1, 2)
     lda_projs = LDA(n_components=n_lda_components).fit_transform(
-        unit_features[kept].reshape(kept.size, -1), unit_max_chans[kept]
+        unit_features.reshape(kept.size, -1), unit_max_chans[kept]
     )
     del unit_features
 
@@ -346,7 +399,7 @@ def maxchan_lda_split(
         clust = HDBSCAN(**hdbscan_kwargs)
         clust.fit(lda_projs)
         new_labels[kept] = clust.labels_
-        is_split = np.setdiff1d(np.unique(new_labels), [-1]).size > 1
+        is_split = has_multiple_labels(new_labels)
     else:
         assert False
 
@@ -362,7 +415,6 @@ def ks_bimodal_pursuit_split(
     max_split_corr=0.9,
     min_amp_sim=0.2,
     min_split_prop=0.05,
-    load_batch_size=512,
     extractor=None,
 ):
     """Adapted from PyKS"""
@@ -375,113 +427,34 @@ def ks_bimodal_pursuit_split(
 
     # load pca embeddings on the max channel
     unit_max_chans = extractor.max_channels[in_unit]
-    ix0, unit_rel_max_chans = np.nonzero(
-        unit_max_chans[:, None] == extractor.channel_index[unit_max_chans]
-    )
-    assert np.array_equal(ix0, np.arange(unit_max_chans.shape[0]))
-    unit_features = np.empty(
-        (in_unit.size, extractor.tpca_projs.shape[1]),
-        dtype=extractor.tpca_projs.dtype,
-    )
-    for bs in range(0, in_unit.size, load_batch_size):
-        be = min(in_unit.size, bs + load_batch_size)
-        unit_features[bs:be] = extractor.tpca_projs[in_unit[bs:be]][
-            np.arange(be - bs), :, unit_rel_max_chans[bs:be]
+    unit_rel_max_chans = extractor.rel_max_channels[unit_max_chans]
+    if isinstance(extractor.tpca_projs, np.ndarray):
+        # gather just the max channel without loading the others
+        unit_features = extractor.tpca_projs[in_unit, :, unit_rel_max_chans]
+    else:
+        unit_features = read_rows(extractor.tpca_projs, in_unit)[
+            np.arange(in_unit.size), :, unit_rel_max_chans
         ]
 
     if unit_rank < unit_features.shape[1]:
-        unit_features = PCA(unit_rank).fit_transform(unit_features)
+        unit_features = PCA(
+            unit_rank, svd_solver="randomized", random_state=0
+        ).fit_transform(unit_features)
 
     if top_pc_init:
         # input should be centered so no problem with centered pca?
-        w = PCA(1).fit(unit_features).components_.squeeze()
+        w = top_principal_component(unit_features)
     else:
         # initialize with the mean of NOT drift-corrected trace
         w = unit_features.mean(axis=0)
         w /= np.linalg.norm(w)
 
-    # initial projections of waveform PCs onto 1D vector
-    x = unit_features @ w
-    x_mean = x.mean()
-    # initialize estimates of variance for the first
-    # and second gaussian in the mixture of 1D gaussians
-    s1 = x[x > x_mean].var()
-    s2 = x[x < x_mean].var()
-    # initialize the means as well
-    mu1 = x[x > x_mean].mean()
-    mu2 = x[x < x_mean].mean()
-    # and the probability that a spike is assigned to the first Gaussian
-    p = (x > x_mean).mean()
-
-    # initialize matrix of log probabilities that each spike is assigned to the first
-    # or second cluster
-    logp = np.zeros((x.shape[0], 2), order="F")
-    # do 50 pursuit iteration
-    logP = np.zeros(50)  # used to monitor the cost function
-
-    # TODO: move_to_config - maybe...
-    for k in range(50):
-        if min(s1, s2) < 1e-6:
-            break
-
-        # for each spike, estimate its probability to come from either Gaussian cluster
-        logp[:, 0] = np.log(s1) / 2 - ((x - mu1) ** 2) / (2 * s1) + np.log(p)
-        logp[:, 1] = (
-            np.log(s2) / 2 - ((x - mu2) ** 2) / (2 * s2) + np.log(1 - p)
-        )
-
-        lMax = logp.max(axis=1)
-        # subtract the max for floating point accuracy
-        logp = logp - lMax[:, np.newaxis]
-        rs = np.exp(logp)
-
-        # get the normalizer and add back the max
-        pval = np.log(np.sum(rs, axis=1)) + lMax
-        # this is the cost function: we can monitor its increase
-        logP[k] = pval.mean()
-        # normalize so that probabilities sum to 1
-        rs /= np.sum(rs, axis=1)[:, np.newaxis]
-        if rs.sum(0).min() < 1e-6:
-            break
-
-        # mean probability to be assigned to Gaussian 1
-        p = rs[:, 0].mean()
-        # new estimate of mean of cluster 1 (weighted by "responsibilities")
-        mu1 = np.dot(rs[:, 0], x) / np.sum(rs[:, 0])
-        # new estimate of mean of cluster 2 (weighted by "responsibilities")
-        mu2 = np.dot(rs[:, 1], x) / np.sum(rs[:, 1])
-
-        # new estimates of variances
-        s1 = np.dot(rs[:, 0], (x - mu1) ** 2) / np.sum(rs[:, 0])
-        s2 = np.dot(rs[:, 1], (x - mu2) ** 2) / np.sum(rs[:, 1])
-
-        if min(s1, s2) < 1e-6:
-            break
-
-        if (k >= 10) and (k % 2 == 0):
-            # starting at iteration 10, we start re-estimating the pursuit direction
-            # that is, given the Gaussian cluster assignments, and the mean and variances,
-            # we re-estimate w
-            # these equations follow from the model
-            StS = (
-                np.matmul(
-                    unit_features.T,
-                    unit_features
-                    * (rs[:, 0] / s1 + rs[:, 1] / s2)[:, np.newaxis],
-                )
-                / unit_features.shape[0]
-            )
-            StMu = (
-                np.dot(
-                    unit_features.T, rs[:, 0] * mu1 / s1 + rs[:, 1] * mu2 / s2
-                )
-                / unit_features.shape[0]
-            )
-
-            # this is the new estimate of the best pursuit direction
-            w = np.linalg.solve(StS.T, StMu)
-            w /= np.linalg.norm(w)
-            x = unit_features @ w
+    # run the pursuit, getting (max-subtracted) log probabilities
+    # that each spike is assigned to the first or second cluster
+    logp = ks_bimodal_em(
+        np.ascontiguousarray(unit_features, dtype=np.float64),
+        np.ascontiguousarray(w, dtype=np.float64),
+    )
 
     # these spikes are assigned to cluster 1
     rs = np.exp(logp)
@@ -501,9 +474,15 @@ def ks_bimodal_pursuit_split(
     c1 = tpca.inverse_transform(unit_features[ilow].mean())
     c2 = tpca.inverse_transform(unit_features[~ilow].mean())
     # correlation of mean waveforms
-    cc = np.corrcoef(c1.ravel(), c2.ravel())[0, 1]
-    n1 = np.linalg.norm(c1)  # the amplitude estimate 1
-    n2 = np.linalg.norm(c2)  # the amplitude estimate 2
+    c1 = np.ravel(c1)
+    c2 = np.ravel(c2)
+    c1_centered = c1 - c1.mean()
+    c2_centered = c2 - c2.mean()
+    cc = (c1_centered @ c2_centered) / np.sqrt(
+        (c1_centered @ c1_centered) * (c2_centered @ c2_centered)
+    )
+    n1 = np.sqrt(c1 @ c1)  # the amplitude estimate 1
+    n2 = np.sqrt(c2 @ c2)  # the amplitude estimate 2
 
     r0 = 2 * abs((n1 - n2) / (n1 + n2))
 
@@ -526,6 +505,146 @@ def ks_bimodal_pursuit_split(
     return False, None, None
 
 
+# serial on purpose: split_clusters already runs units in parallel, and
+# units are small enough that prange's thread startup outweighs the loop
+@numba.jit(nopython=True, cache=True)
+def ks_bimodal_em(unit_features, w, n_iter=50):
+    """Bimodal pursuit EM iterations for ks_bimodal_pursuit_split
+
+    Fits a mixture of two 1D Gaussians to the projections of
+    unit_features onto w, re-estimating w as it goes. Returns the
+    per-spike log probabilities (with the per-spike max subtracted)
+    from the last iteration.
+    """
+    N = unit_features.shape[0]
+
+    # initial projections of waveform PCs onto 1D vector
+    x = unit_features @ w
+    x_mean = x.mean()
+    # initialize estimates of variance for the first
+    # and second gaussian in the mixture of 1D gaussians
+    s1 = x[x > x_mean].var()
+    s2 = x[x < x_mean].var()
+    # initialize the means as well
+    mu1 = x[x > x_mean].mean()
+    mu2 = x[x < x_mean].mean()
+    # and the probability that a spike is assigned to the first Gaussian
+    p = (x > x_mean).mean()
+
+    # initialize matrix of log probabilities that each spike is assigned
+    # to the first or second cluster, and the responsibilities
+    # (stored cluster-major so that the dot products are contiguous)
+    logp = np.zeros((N, 2))
+    rs = np.empty((2, N))
+    logP = np.zeros(n_iter)  # used to monitor the cost function
+
+    for k in range(n_iter):
+        if min(s1, s2) < 1e-6:
+            break
+
+        # for each spike, estimate its probability to come from either
+        # Gaussian cluster. this is done in one pass per spike: subtract
+        # the max for floating point accuracy, get the normalizer (adding
+        # back the max for the cost function), and normalize so that
+        # probabilities sum to 1. with two clusters, one of the max-
+        # subtracted log probabilities is 0, so one exp is enough.
+        # we also accumulate the total responsibility of each cluster
+        # and the weighted sums for the means in the same pass.
+        c1 = np.log(s1) / 2 + np.log(p)
+        c2 = np.log(s2) / 2 + np.log(1 - p)
+        pval_sum = 0.0
+        n1 = n2 = 0.0
+        xsum1 = xsum2 = 0.0
+        for i in range(N):
+            l1 = c1 - ((x[i] - mu1) ** 2) / (2 * s1)
+            l2 = c2 - ((x[i] - mu2) ** 2) / (2 * s2)
+            if l1 >= l2:
+                logp[i, 0] = 0.0
+                logp[i, 1] = l2 - l1
+                e = np.exp(l2 - l1)
+                pval_sum += np.log1p(e) + l1
+                rs[0, i] = 1.0 / (1.0 + e)
+                rs[1, i] = e / (1.0 + e)
+            else:
+                logp[i, 0] = l1 - l2
+                logp[i, 1] = 0.0
+                e = np.exp(l1 - l2)
+                pval_sum += np.log1p(e) + l2
+                rs[0, i] = e / (1.0 + e)
+                rs[1, i] = 1.0 / (1.0 + e)
+            n1 += rs[0, i]
+            n2 += rs[1, i]
+            xsum1 += rs[0, i] * x[i]
+            xsum2 += rs[1, i] * x[i]
+        # this is the cost function: we can monitor its increase
+        logP[k] = pval_sum / N
+        if min(n1, n2) < 1e-6:
+            break
+
+        # mean probability to be assigned to Gaussian 1
+        p = n1 / N
+        # new estimate of mean of cluster 1 (weighted by "responsibilities")
+        mu1 = xsum1 / n1
+        # new estimate of mean of cluster 2 (weighted by "responsibilities")
+        mu2 = xsum2 / n2
+
+        # new estimates of variances
+        ssq1 = ssq2 = 0.0
+        for i in range(N):
+            ssq1 += rs[0, i] * (x[i] - mu1) ** 2
+            ssq2 += rs[1, i] * (x[i] - mu2) ** 2
+        s1 = ssq1 / n1
+        s2 = ssq2 / n2
+
+        if min(s1, s2) < 1e-6:
+            break
+
+        if (k >= 10) and (k % 2 == 0):
+            # starting at iteration 10, we start re-estimating the pursuit
+            # direction that is, given the Gaussian cluster assignments,
+            # and the mean and variances, we re-estimate w
+            # these equations follow from the model
+            StS = (
+                unit_features.T
+                @ (unit_features * (rs[0] / s1 + rs[1] / s2)[:, None])
+                / N
+            )
+            StMu = (
+                unit_features.T @ (rs[0] * mu1 / s1 + rs[1] * mu2 / s2)
+            ) / N
+
+            # this is the new estimate of the best pursuit direction
+            # StS is symmetric positive (semi-)definite, so we can use a
+            # (slightly regularized) Cholesky solve rather than an LU
+            w = cholesky_solve(StS + 1e-8 * np.eye(StS.shape[0]), StMu)
+            w /= np.linalg.norm(w)
+            x = unit_features @ w
+
+    return logp
+
+
+@numba.jit(nopython=True, cache=True)
+def cholesky_solve(A, b):
+    """Solve A x = b for symmetric positive definite A"""
+    L = np.linalg.cholesky(A)
+    n = b.shape[0]
+    # forward substitution: L y = b
+    y = np.empty(n)
+    for i in range(n):
+        acc = b[i]
+        for j in range(i):
+            acc -= L[i, j] * y[j]
+        y[i] = acc / L[i, i]
+    # back substitution: L.T x = y
+    x = np.empty(n)
+    for i in range(n - 1, -1, -1):
+        acc = y[i]
+        for j in range(i + 1, n):
+            acc -= L[j, i] * x[j]
+        x[i] = acc / L[i, i]
+    return x
+
+
 # main function
 
 
@@ -541,6 +660,9 @@ def split_clusters(
     recursive_steps=(False, True, True),
     split_step_kwargs=None,
     relocated=False,
+    h5_cache_nbytes=512 * 1024 * 1024,
+    max_tpca_in_memory_nbytes=2 * 1024 * 1024 * 1024,
+    executor_kind="processes",
 ):
     contig = labels.max() + 1 == np.unique(labels[labels >= 0]).size
     if not contig:
@@ -566,74 +688,113 @@ def split_clusters(
 
     # set up multiprocessing.
     # Mock has better error messages, will be used with n_workers in (0, 1)
+    # with executor_kind="threads", workers share one extractor which is
+    # set up here. this avoids spawning and pickling, and works since the
+    # split steps spend their time in numpy/h5py/sklearn, releasing the GIL
+    if executor_kind not in ("processes", "threads"):
+        raise ValueError(f"{executor_kind=} not in ('processes', 'threads')")
     spawn = n_workers not in (0, 1)
-    Executor = ProcessPoolExecutor if spawn else MockPoolExecutor
-    context = multiprocessing.get_context("spawn") if spawn else None
-    with Executor(
-        max_workers=n_workers,
-        mp_context=context,
-        initializer=split_worker_init,
-        initargs=(
-            h5_path,
-            log_c,
-            feature_scales,
-            waveforms_kind,
-            raw_data_bin,
-            relocated,
-        ),
-    ) as pool:
-        # we will do each split step one after the other, each
-        # starting with the labels set output by the previous step
-        for split_step, recursive, extra_kwargs in zip(
-            split_steps, recursive_steps, split_step_kwargs
-        ):
-            split_step_wrapped = split_fn_wrapper(split_step, extra_kwargs)
-            cur_labels_set = np.setdiff1d(new_labels, [-1])
-            cur_max_label = cur_labels_set.max()
-            nlabels_cur = cur_max_label + 1
-
-            jobs = [
-                pool.submit(
-                    split_step_wrapped, np.flatnonzero(new_labels == i)
-                )
-                for i in cur_labels_set
-            ]
-            iterator = tqdm(
-                jobs,
-                desc=f"Split step: {split_step.__name__}",
-                total=len(cur_labels_set),
-                smoothing=0,
-            )
-            for future in iterator:
-                # would be better to do this like "imap style" but not
-                # sure how to do that... anyway its ok.
-                is_split, unit_new_labels, in_unit = future.result()
-
-                if not is_split:
-                    continue
-
-                # -1 will become -1, 0 will keep its current label
-                # 1 and on will start at next_label
-                unit_new_labels[unit_new_labels > 0] += cur_max_label
-                new_labels[in_unit[unit_new_labels < 0]] = unit_new_labels[
-                    unit_new_labels < 0
-                ]
-                new_labels[in_unit[unit_new_labels > 0]] = unit_new_labels[
-                    unit_new_labels > 0
-                ]
-                cur_max_label = new_labels[in_unit].max()
-
-                if recursive:
-                    new_jobs = np.setdiff1d(new_labels[in_unit], [-1])
-                    jobs.extend(
-                        pool.submit(
+    # max_tpca_in_memory_nbytes is a total: each worker process loads its
+    # own copy of the tpca embeddings, while threads share one
+    if spawn and executor_kind == "processes":
+        max_tpca_in_memory_nbytes //= n_workers
+    initargs = (
+        h5_path,
+        log_c,
+        feature_scales,
+        waveforms_kind,
+        raw_data_bin,
+        relocated,
+        h5_cache_nbytes,
+        max_tpca_in_memory_nbytes,
+    )
+    if spawn and executor_kind == "threads":
+        split_worker_init(*initargs)
+        pool = ThreadPoolExecutor(max_workers=n_workers)
+    elif spawn:
+        pool = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=split_worker_init,
+            initargs=initargs,
+        )
+    else:
+        pool = MockPoolExecutor(
+            initializer=split_worker_init, initargs=initargs
+        )
+    is_mock = isinstance(pool, MockPoolExecutor)
+    try:
+        with pool:
+            # we will do each split step one after the other, each
+            # starting with the labels set output by the previous step
+            for split_step, recursive, extra_kwargs in zip(
+                split_steps, recursive_steps, split_step_kwargs
+            ):
+                split_step_wrapped = split_fn_wrapper(split_step, extra_kwargs)
+                cur_labels_set = np.setdiff1d(new_labels, [-1])
+                cur_max_label = cur_labels_set.max()
+                nlabels_cur = cur_max_label + 1
+
+                # handle results as they come in, so that slow units don't
+                # hold up the rest and recursive jobs start right away.
+                # units' spikes are disjoint, so the order does not matter.
+                # futures are put in this queue when they finish (MockFutures
+                # run when their result is asked for, so those are queued in
+                # submission order)
+                completed = queue.SimpleQueue()
+
+                def submit_units(units):
+                    for i in units:
+                        future = pool.submit(
                             split_step_wrapped, np.flatnonzero(new_labels == i)
                         )
-                        for i in new_jobs
-                    )
-                    iterator.total += len(new_jobs)
-
-            print(f"{new_labels.max() + 1 - nlabels_cur} new units.")
+                        if is_mock:
+                            completed.put(future)
+                        else:
+                            future.add_done_callback(completed.put)
+                    return len(units)
+
+                n_pending = submit_units(cur_labels_set)
+                pbar = tqdm(
+                    desc=f"Split step: {split_step.__name__}",
+                    total=len(cur_labels_set),
+                    smoothing=0,
+                )
+                while n_pending:
+                    future = completed.get()
+                    n_pending -= 1
+                    pbar.update()
+                    is_split, unit_new_labels, in_unit = future.result()
+
+                    if not is_split:
+                        continue
+
+                    # -1 will become -1, 0 will keep its current label
+                    # 1 and on will start at next_label
+                    unit_new_labels[unit_new_labels > 0] += cur_max_label
+                    new_labels[in_unit[unit_new_labels < 0]] = unit_new_labels[
+                        unit_new_labels < 0
+                    ]
+                    new_labels[in_unit[unit_new_labels > 0]] = unit_new_labels[
+                        unit_new_labels > 0
+                    ]
+                    cur_max_label = new_labels[in_unit].max()
+
+                    if recursive:
+                        new_jobs = np.setdiff1d(new_labels[in_unit], [-1])
+                        n_pending += submit_units(new_jobs)
+                        pbar.total += len(new_jobs)
+                        pbar.refresh()
+                pbar.close()
+
+                print(f"{new_labels.max() + 1 - nlabels_cur} new units.")
+    finally:
+        # with threads (or no concurrency), the workers' extractor lives in
+        # this process. drop it so that its h5 handle, chunk cache and
+        # in-memory tpca embeddings don't outlive this call
+        if not spawn or executor_kind == "threads":
+            split_worker_init.extractor.h5.close()
+            del split_worker_init.extractor
 
     return new_labels
 
@@ -697,16 +858,16 @@ def lda_diptest_merge(
             geom,
             T=T,
         )
+        too_far_a = np.isnan(feats_a).any(axis=(1, 2))
+        feats_a = feats_a[~too_far_a]
     else:
-        feats_a = get_pca_projs_on_channel_subset(
+        feats_a, too_far_a = get_pca_projs_on_channel_subset(
             in_unit_a,
             tpca_projs,
             max_channels,
             channel_index,
             which_chans,
         )
-    too_far_a = np.isnan(feats_a).any(axis=(1, 2))
-    feats_a = feats_a[~too_far_a]
     if relocated:
         feats_b, relocated_maxptps = get_relocated_wfs_on_channel_subset(
             in_unit_b,
@@ -723,16 +884,16 @@ def lda_diptest_merge(
             geom,
             T=T,
         )
+        too_far_b = np.isnan(feats_b).any(axis=(1, 2))
+        feats_b = feats_b[~too_far_b]
     else:
-        feats_b = get_pca_projs_on_channel_subset(
+        feats_b, too_far_b = get_pca_projs_on_channel_subset(
             in_unit_b,
             tpca_projs,
             max_channels,
             channel_index,
             which_chans,
         )
-    too_far_b = np.isnan(feats_b).any(axis=(1, 2))
-    feats_b = feats_b[~too_far_b]
     del in_unit_a, in_unit_b
 
     if min(feats_a.shape[0], feats_b.shape[0]) < min_spikes:
@@ -740,28 +901,33 @@ def lda_diptest_merge(
 
     # invert the tpca and align the times according to shift
     # shift is trough[b] - trough[a] here
+    # waveforms are kept in (N, C, T) layout from here on, so that
+    # the reshape for the shared pca below does not need a copy
     if relocated:
-        wfs_a = feats_a
-        wfs_b = feats_b
+        wfs_a = feats_a.transpose(0, 2, 1)
+        wfs_b = feats_b.transpose(0, 2, 1)
     else:
         wfs_a = invert_tpca(feats_a, tpca.tpca)
         wfs_b = invert_tpca(feats_b, tpca.tpca)
     del feats_a, feats_b
 
     if shift > 0:
-        wfs_a = wfs_a[:, :-shift, :]
-        wfs_b = wfs_b[:, shift:, :]
+        wfs_a = wfs_a[:, :, :-shift]
+        wfs_b = wfs_b[:, :, shift:]
     elif shift < 0:
-        wfs_a = wfs_a[:, -shift:, :]
-        wfs_b = wfs_b[:, :shift, :]
+        wfs_a = wfs_a[:, :, -shift:]
+        wfs_b = wfs_b[:, :, :shift]
 
     # apply a shared pca to both units (???)
+    # LDA is invariant to the (injective, linear) inverse transform of
+    # the shared pca, so we fit it directly to the pca coefficients
+    # rather than reconstructing the waveforms first
     wfs = np.concatenate((wfs_a, wfs_b))
-    Ntot, T, C = wfs.shape
-    wfs = wfs.transpose(0, 2, 1).reshape(Ntot * C, T)
-    shared_tpca = PCA(tpca_rank)
-    wfs = shared_tpca.inverse_transform(shared_tpca.fit_transform(wfs))
-    wfs = wfs.reshape(Ntot, C * T)
+    Ntot, C, T = wfs.shape
+    wfs = wfs.reshape(Ntot * C, T)
+    shared_tpca = PCA(tpca_rank, svd_solver="randomized", random_state=0)
+    wfs = shared_tpca.fit_transform(wfs)
+    wfs = wfs.reshape(Ntot, C * tpca_rank)
 
     # LDA project and dip test
     labels = np.ones(Ntot, dtype=int)
@@ -792,18 +958,32 @@ def get_proposed_pairs_for_unit(
     n_jobs=-1,
     lambd=0.001,
     allowed_scale=0.1,
+    n_nearest=None,
 ):
+    template = templates_dict[unit]
     other_templates = np.stack(
         [templates_dict[j] for j in other_units], axis=0
     )
+    template_sqnorm = np.square(template).sum()
+    other_sqnorms = np.square(other_templates).sum(axis=(1, 2))
     deconv_threshold = deconv_threshold_mul * min(
-        np.square(templates_dict[unit]).sum(),
-        np.square(other_templates).sum(axis=(1, 2)).min(),
+        template_sqnorm, other_sqnorms.min()
     )
 
+    # optionally only compute resid distances to the n_nearest templates
+    # in L2, since the deconvolution is expensive. this distance does not
+    # search over shifts, so a pair whose templates only line up after a
+    # shift can be missed. n_nearest=None (default) checks them all.
+    if n_nearest is not None and n_nearest < len(other_units):
+        dots = other_templates.reshape(len(other_units), -1) @ template.ravel()
+        sqdists = template_sqnorm + other_sqnorms - 2 * dots
+        nearest = np.argpartition(sqdists, n_nearest)[:n_nearest]
+        other_units = [other_units[j] for j in nearest]
+        other_templates = other_templates[nearest]
+
     # shifts[i, j] is like trough[j] - trough[i]
     resids, shifts = calc_resid_matrix(
-        templates_dict[unit][None],
+        template[None],
         np.array([unit]),
         other_templates,
         np.array(other_units),
@@ -840,12 +1020,15 @@ def merge_clusters(
     labels,
     templates,
     proposal_max_resid_dist=15,
+    proposal_n_nearest=None,
     threshold_diptest=0.5,
     waveforms_kind="cleaned",
     recursive=True,
     relocated=False,
     trough_offset=42,
     n_jobs=-1,
+    h5_cache_nbytes=512 * 1024 * 1024,
+    max_tpca_in_memory_nbytes=2 * 1024 * 1024 * 1024,
 ):
 
     orig_labels, orig_counts = np.unique(
@@ -865,7 +1048,7 @@ def merge_clusters(
     del templates
 
     # load some stuff from the h5
-    h5 = h5py.File(h5_path, "r")
+    h5 = open_h5_with_cache(h5_path, h5_cache_nbytes)
     geom = h5["geom"][:]
     spike_times, max_channels = h5["spike_index"][:].T
     # TODO: these right now are just use for computing templates
@@ -873,7 +1056,7 @@ def merge_clusters(
     #       really handled correctly, but it's hard to do it right
     aligned_times = spike_times.copy()
     channel_index = h5["channel_index"][:]
-    tpca_projs = h5[f"{waveforms_kind}_tpca_projs"]
+    tpca_projs = load_tpca_projs(h5, waveforms_kind, max_tpca_in_memory_nbytes)
     tpca_feat = TPCA(tpca_projs.shape[1], channel_index, waveforms_kind)
     tpca_feat.from_h5(h5)
 
@@ -899,6 +1082,7 @@ def merge_clusters(
             templates_dict,
             max_resid_dist=proposal_max_resid_dist,
             n_jobs=n_jobs,
+            n_nearest=proposal_n_nearest,
         )
         # print(label, proposals.size)
 
@@ -949,18 +1133,20 @@ def merge_clusters(
                 # remove candidate from the labels to process
                 # we know this item is in there, so this will not ValueError
                 labels_to_process.remove(candidate)
-
-                # update with a new template
                 del templates_dict[candidate]
-                templates_dict[label] = get_raw_template_single(
-                    aligned_times[new_labels == label],
-                    raw_data_bin,
-                    n_channels,
-                    trough_offset=trough_offset,
-                    spike_length_samples=spike_length_samples,
-                )
 
                 if recursive:
+                    # update with a new template. this is only needed
+                    # if the merged unit will be processed again, so
+                    # we can skip reading the raw data otherwise
+                    templates_dict[label] = get_raw_template_single(
+                        aligned_times[new_labels == label],
+                        raw_data_bin,
+                        n_channels,
+                        trough_offset=trough_offset,
+                        spike_length_samples=spike_length_samples,
+                    )
+
                     # we add this to the end of the list,
                     # so it's up next for processing.
                     labels_to_process.append(label)
@@ -1029,34 +1215,158 @@ def get_pca_projs_on_channel_subset(
     max_channels,
     channel_index,
     which_chans,
-    load_batch_size=512,
+    rel_sub_channel_index=None,
 ):
-    # load pca projected spikes for this unit
-    these_tpca_projs = np.empty(
-        (which.size, *tpca_projs.shape[1:]), dtype=tpca_projs.dtype
-    )
-    for bs in range(0, which.size, load_batch_size):
-        be = bs + load_batch_size
-        these_tpca_projs[bs:be] = tpca_projs[which[bs:be]]
+    """Load tpca projections of spikes `which` on the channels `which_chans`
+
+    Some spikes' channel neighborhoods do not include all of these
+    channels. This returns a boolean array `too_far` marking them, and
+    the projections of the other spikes, `which[~too_far]`, which are
+    the only ones loaded. `rel_sub_channel_index` can be passed if it
+    was already computed by get_rel_sub_channel_index for `which_chans`.
+    """
+    C = tpca_projs.shape[2]
 
     # which channels do we load, as a function of max channel
-    channel_index_mask = np.isin(channel_index, which_chans)
+    if rel_sub_channel_index is None:
+        rel_sub_channel_index = get_rel_sub_channel_index(
+            channel_index, which_chans
+        )
+    these_rel_chans = rel_sub_channel_index[max_channels[which]]
+    too_far = (these_rel_chans == C).any(axis=1)
+    these_rel_chans = these_rel_chans[~too_far]
+
+    # load pca projected spikes for this unit, and gather
+    # pca projs on those channels
+    these_tpca_projs = read_rows(tpca_projs, which[~too_far])
+    these_tpca_projs = np.take_along_axis(
+        these_tpca_projs, these_rel_chans[:, None, :], axis=2
+    )
 
-    # gather pca projs on those channels
-    these_tpca_projs = get_channel_subset(
-        these_tpca_projs,
-        max_channels[which],
-        channel_index_mask,
+    return these_tpca_projs, too_far
+
+
+def get_rel_sub_channel_index(channel_index, which_chans):
+    """Positions of which_chans within each row of channel_index
+
+    Same as the relative index built by waveform_utils.get_channel_subset
+    for the mask np.isin(channel_index, which_chans), but without a Python
+    loop over channels: row c holds the (increasing) positions in
+    channel_index[c] of the channels in which_chans, padded with
+    C = channel_index.shape[1].
+    """
+    n_channels, C = channel_index.shape
+    # lookup table rather than np.isin. channel_index is padded with
+    # n_channels, which is never in the subset
+    in_subset = np.zeros(n_channels + 1, dtype=bool)
+    in_subset[which_chans] = True
+    channel_index_mask = in_subset[channel_index]
+    max_sub_chans = channel_index_mask.sum(axis=1).max()
+    rel_sub_channel_index = np.where(channel_index_mask, np.arange(C), C)
+    rel_sub_channel_index.sort(axis=1)
+    return rel_sub_channel_index[:, :max_sub_chans]
+
+
+def open_h5_with_cache(h5_path, h5_cache_nbytes):
+    """Open an h5 for reading with a large chunk cache
+
+    The default 1MB cache is evicted by every unit's fancy read, so
+    repeated reads of overlapping rows would go back to disk.
+    """
+    return h5py.File(
+        h5_path,
+        "r",
+        rdcc_nbytes=h5_cache_nbytes,
+        rdcc_nslots=1_000_003,
+        rdcc_w0=0.0,
     )
 
-    return these_tpca_projs
+
+def load_tpca_projs(h5, waveforms_kind, max_tpca_in_memory_nbytes):
+    """Load the tpca embeddings into memory if they are small enough
+
+    Otherwise, return a reference to the h5 dataset. Indexing into an
+    in-memory array is much cheaper than going through h5py.
+    """
+    tpca_projs = h5[f"{waveforms_kind}_tpca_projs"]
+    nbytes = tpca_projs.size * tpca_projs.dtype.itemsize
+    if nbytes <= max_tpca_in_memory_nbytes:
+        tpca_projs = tpca_projs[:]
+    return tpca_projs
+
+
+def read_rows(dataset, which):
+    """Load dataset[which] in a single read
+
+    h5py wants increasing and unique indices for fancy reads, so we
+    read the sorted unique rows once and reorder them in memory. This
+    avoids paying h5py's per-call overhead on many small batches.
+    """
+    if not which.size:
+        return np.empty((0, *dataset.shape[1:]), dtype=dataset.dtype)
+    if isinstance(dataset, np.ndarray):
+        return dataset[which]
+    if np.all(np.diff(which) > 0):
+        return read_increasing_rows(dataset, which)
+    unique_which, inverse = np.unique(which, return_inverse=True)
+    return read_increasing_rows(dataset, unique_which)[inverse]
+
+
+def read_increasing_rows(dataset, which, max_runs_frac=0.125):
+    """Read increasing rows of an h5py dataset, using slices for runs
+
+    h5py's point selection is slow for long index lists, while slices
+    use the hyperslab fast path. If `which` is made of few enough
+    contiguous runs, read each run as a slice, otherwise do one fancy
+    read.
+    """
+    breaks = np.flatnonzero(np.diff(which) != 1) + 1
+    if breaks.size + 1 > max_runs_frac * which.size:
+        return dataset[which]
+
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [which.size]))
+    out = np.empty((which.size, *dataset.shape[1:]), dtype=dataset.dtype)
+    for start, end in zip(starts, ends):
+        dataset.read_direct(
+            out,
+            source_sel=np.s_[which[start] : which[end - 1] + 1],
+            dest_sel=np.s_[start:end],
+        )
+    return out
+
+
+def top_principal_component(X, n_iter=3, seed=0):
+    """Approximate first principal component of X by power iteration
+
+    This is only used as an initialization, so a few iterations are
+    enough. The sign is fixed like sklearn's PCA: the largest entry
+    in absolute value is positive.
+    """
+    X = X - X.mean(axis=0)
+    v = np.random.default_rng(seed).standard_normal(X.shape[1])
+    for _ in range(n_iter):
+        v = X.T @ (X @ v)
+        v /= np.linalg.norm(v)
+    v *= np.sign(v[np.abs(v).argmax()])
+    return v
+
+
+def has_multiple_labels(labels):
+    """Are there at least two distinct labels (ignoring -1) in `labels`?
+
+    This is a linear scan, rather than sorting with np.unique.
+    """
+    labels = labels[labels >= 0]
+    return bool(labels.size) and bool((labels != labels[0]).any())
 
 
 def invert_tpca(projs, tpca):
+    """(N, R, C) tpca projections -> (N, C, T) waveforms"""
     N, R, C = projs.shape
     projs = projs.transpose(0, 2, 1)
     wfs = tpca.inverse_transform(projs.reshape(-1, R))
-    return wfs.reshape(N, C, -1).transpose(0, 2, 1)
+    return wfs.reshape(N, C, -1)
 
 
 # -- parallelism helpers
@@ -1070,6 +1380,8 @@ def split_worker_init(
     waveforms_kind,
     raw_data_bin,
     relocated,
+    h5_cache_nbytes,
+    max_tpca_in_memory_nbytes,
 ):
     """
     Loads hdf5 datasets on each worker process, rather than
@@ -1084,6 +1396,8 @@ def split_worker_init(
         log_c=log_c,
         feature_scales=feature_scales,
         waveforms_kind=waveforms_kind,
+        h5_cache_nbytes=h5_cache_nbytes,
+        max_tpca_in_memory_nbytes=max_tpca_in_memory_nbytes,
     )
     p.relocated = relocated
 
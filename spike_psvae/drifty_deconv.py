@@ -20,8 +20,11 @@ def superres_spike_train(
     superres_labels = np.full_like(spike_train[:, 1], -1)
     # this will keep track of which superres template corresponds to which bin,
     # information which we will need later to determine how to shift the templates
-    superres_label_to_bin_id = []
-    superres_label_to_orig_label = []
+    # every superres label has at least one spike, so the number of labeled
+    # spikes bounds the number of superres labels
+    n_labeled = np.count_nonzero(spike_train[:, 1] >= 0)
+    superres_label_to_bin_id = np.empty(n_labeled, dtype=np.int32)
+    superres_label_to_orig_label = np.empty(n_labeled, dtype=spike_train.dtype)
     unit_labels = np.unique(spike_train[spike_train[:, 1] >= 0, 1])
     cur_superres_label = 0
     for u in unit_labels:
@@ -36,33 +39,46 @@ def superres_spike_train(
         # this corresponds to bins like:
         #      ... | bin -1 | bin 0 | bin 1 | ...
         #   ... -3bin/2 , -bin/2, bin/2, 3bin/2, ...
-        bin_ids = (centered_z + bin_size_um / 2) // bin_size_um
-        occupied_bins, bin_counts = np.unique(bin_ids, return_counts=True)
+        bin_ids = np.floor_divide(
+            centered_z + bin_size_um / 2, bin_size_um
+        ).astype(np.int32)
+        # bin ids are small integers, so bincount is cheaper than np.unique
+        bin_min = bin_ids.min()
+        counts = np.bincount(bin_ids - bin_min)
+        occupied_bins = (np.flatnonzero(counts) + bin_min).astype(np.int32)
+        bin_counts = counts[occupied_bins - bin_min]
         if max_z_dist is not None:
             # np.abs(bin_ids) <= (np.abs(centered_z)+ bin_size_um / 2)//bin_size_um <= (max_z_dist + bin_size_um / 2)//bin_size_um
-            bin_counts = bin_counts[
+            in_range = (
                 np.abs(occupied_bins)
                 <= (max_z_dist + bin_size_um / 2) // bin_size_um
-            ]
-            occupied_bins = occupied_bins[
-                np.abs(occupied_bins)
-                <= (max_z_dist + bin_size_um / 2) // bin_size_um
-            ]
+            )
+            bin_counts = bin_counts[in_range]
+            occupied_bins = occupied_bins[in_range]
         if bin_counts.max() >= min_spikes_bin:
-            for bin_id in occupied_bins[bin_counts >= min_spikes_bin]:
-                superres_labels[in_u[bin_ids == bin_id]] = cur_superres_label
-                superres_label_to_bin_id.append(bin_id)
-                superres_label_to_orig_label.append(u)
-                cur_superres_label += 1
+            kept_bins = occupied_bins[bin_counts >= min_spikes_bin]
+            in_kept = np.isin(bin_ids, kept_bins)
+            superres_labels[in_u[in_kept]] = cur_superres_label + np.searchsorted(
+                kept_bins, bin_ids[in_kept]
+            )
+            n_new = kept_bins.size
+            superres_label_to_bin_id[
+                cur_superres_label : cur_superres_label + n_new
+            ] = kept_bins
         # what if no template was computed for u
         else:
             superres_labels[in_u] = cur_superres_label
-            superres_label_to_bin_id.append(0)
-            superres_label_to_orig_label.append(u)
-            cur_superres_label += 1
-
-    superres_label_to_bin_id = np.array(superres_label_to_bin_id)
-    superres_label_to_orig_label = np.array(superres_label_to_orig_label)
+            n_new = 1
+            superres_label_to_bin_id[cur_superres_label] = 0
+        superres_label_to_orig_label[
+            cur_superres_label : cur_superres_label + n_new
+        ] = u
+        cur_superres_label += n_new
+
+    superres_label_to_bin_id = superres_label_to_bin_id[:cur_superres_label]
+    superres_label_to_orig_label = superres_label_to_orig_label[
+        :cur_superres_label
+    ]
     return (
         superres_labels,
         superres_label_to_bin_id,
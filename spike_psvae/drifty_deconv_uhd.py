@@ -1,13 +1,21 @@
 # %%
 # %%
 import h5py
+import numba
 import numpy as np
 import tempfile
 from pathlib import Path
 from tqdm.auto import tqdm
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from joblib import Parallel, delayed
+from scipy.spatial.distance import cdist
 from . import deconvolve, snr_templates, spike_train_utils, reassignment
-from .waveform_utils import get_pitch, pitch_shift_templates
+from .waveform_utils import (
+    get_pitch,
+    pitch_shift_channels,
+    pitch_shift_templates,
+)
 from .extract_deconv import extract_deconv
 
 
@@ -35,80 +43,83 @@ def superres_spike_train(
 
     # bin the spikes to create a binned "superres spike train"
     # we'll use this spike train in an expanded label space to compute templates
-    superres_labels = np.full_like(spike_train_no_outliers[:, 1], -1)
-    # this will keep track of which superres template corresponds to which bin,
-    # information which we will need later to determine how to shift the templates
-    n_spikes_per_bin = []
-    superres_label_to_bin_id = []
-    superres_label_to_orig_label = []
-    unit_max_channels = []
-    unit_labels = np.unique(spike_train_no_outliers[spike_train_no_outliers[:, 1] >= 0, 1])
+    labels = spike_train_no_outliers[:, 1]
+    superres_labels = np.full_like(labels, -1)
+    unit_labels = np.unique(labels[labels >= 0])
     medians_at_computation = np.zeros(unit_labels.max()+1)
-    cur_superres_label = 0
-    for u in unit_labels:
-        in_u = np.flatnonzero(spike_train_no_outliers[:, 1] == u)
-
-        # Get most recent spikes
-        count_unit = np.logical_and(spike_train_no_outliers[:, 0]<t_end*fs, spike_train_no_outliers[:, 1]==u).sum()
-        if count_unit>n_spikes_max_recent:
-            in_u = np.flatnonzero(np.logical_and(spike_train_no_outliers[:, 0]<t_end*fs, 
-                                                           spike_train_no_outliers[:, 1]==u))[-n_spikes_max_recent:]
-        else:
-            in_u = np.flatnonzero(spike_train_no_outliers[:, 1]==u)[:n_spikes_max_recent]
-
-        # center the z positions in this unit using the median
-        centered_z = z_abs[in_u].copy()
-        medians_at_computation[u] = np.median(centered_z)
-        centered_z -= medians_at_computation[u]
-
-        # convert them to bin identities by adding half the bin size and
-        # floor dividing by the bin size
-        # this corresponds to bins like:
-        #      ... | bin -1 | bin 0 | bin 1 | ...
-        #   ... -3bin/2 , -bin/2, bin/2, 3bin/2, ...
-        bin_ids = (centered_z + bin_size_um / 2) // bin_size_um
-        occupied_bins, bin_counts = np.unique(bin_ids, return_counts=True)
-        if units_spread is not None:
-            # np.abs(bin_ids) <= (np.abs(centered_z)+ bin_size_um / 2)//bin_size_um <= (max_z_dist + bin_size_um / 2)//bin_size_um
-            bin_counts = bin_counts[
-                np.abs(occupied_bins)
-                <= (units_spread[u] + bin_size_um / 2) // bin_size_um
-            ]
-            occupied_bins = occupied_bins[
-                np.abs(occupied_bins)
-                <= (units_spread[u] + bin_size_um / 2) // bin_size_um
-            ]
-        # IS THAT NEEDED - min_spikes_bin removed here and used during template augmentation
-#         if min_spikes_bin is None:
-        for j, bin_id in enumerate(occupied_bins):
-            superres_labels[in_u[bin_ids == bin_id]] = cur_superres_label
-            superres_label_to_bin_id.append(bin_id)
-            unit_max_channels.append(np.sum((geom - [np.median(x[in_u[bin_ids == bin_id]]), np.median(z_abs[in_u[bin_ids == bin_id]])])**2, axis=1).argmin())
-            superres_label_to_orig_label.append(u)
-            n_spikes_per_bin.append(bin_counts[j])
-            cur_superres_label += 1
-#         else:
-#             if bin_counts.max() >= min_spikes_bin:
-#                 for j, bin_id in enumerate(occupied_bins[bin_counts >= min_spikes_bin]):
-#                     superres_labels[in_u[bin_ids == bin_id]] = cur_superres_label
-#                     superres_label_to_bin_id.append(bin_id)
-#                     superres_label_to_orig_label.append(u)
-#                     n_spikes_per_bin.append(bin_counts[j])
-#                     unit_max_channels.append(np.sum((geom - [np.median(x[in_u[bin_ids == bin_id]]), np.median(z_abs[in_u[bin_ids == bin_id]])])**2, axis=1).argmin())
-#                     cur_superres_label += 1
-#             # what if no template was computed for u
-#             else:
-#                 superres_labels[in_u] = cur_superres_label
-#                 superres_label_to_bin_id.append(0)
-#                 superres_label_to_orig_label.append(u)
-#                 n_spikes_per_bin.append(in_u.shape[0])
-#                 unit_max_channels.append(np.sum((geom - [np.median(x[in_u]), np.median(z_abs[in_u])])**2, axis=1).argmin())
-#                 cur_superres_label += 1
-
-    superres_label_to_bin_id = np.array(superres_label_to_bin_id)
-    superres_label_to_orig_label = np.array(superres_label_to_orig_label)
-    n_spikes_per_bin = np.array(n_spikes_per_bin)
-    unit_max_channels = np.array(unit_max_channels)
+
+    # Get most recent spikes: units with more than n_spikes_max_recent spikes
+    # before t_end keep the last n_spikes_max_recent of those, the others keep
+    # their first n_spikes_max_recent spikes
+    valid = labels >= 0
+    recent = valid & (spike_train_no_outliers[:, 0] < t_end * fs)
+    use_recent = np.bincount(
+        labels[recent], minlength=unit_labels.max() + 1
+    ) > n_spikes_max_recent
+    candidates = np.flatnonzero(
+        valid & (recent | ~use_recent[np.maximum(labels, 0)])
+    )
+    # stable sort groups the spikes by unit and keeps their order within units
+    in_units = candidates[np.argsort(labels[candidates], kind="stable")]
+    unit_ix = np.searchsorted(unit_labels, labels[in_units])
+    unit_counts = np.bincount(unit_ix, minlength=unit_labels.size)
+    unit_starts = np.cumsum(unit_counts) - unit_counts
+    rank = np.arange(in_units.size) - unit_starts[unit_ix]
+    keep = np.where(
+        use_recent[unit_labels[unit_ix]],
+        rank >= unit_counts[unit_ix] - n_spikes_max_recent,
+        rank < n_spikes_max_recent,
+    )
+    in_units = in_units[keep]
+    unit_ix = unit_ix[keep]
+
+    # center the z positions in each unit using the median
+    unit_medians = grouped_median(z_abs[in_units], unit_ix, unit_labels.size)
+    medians_at_computation[unit_labels] = unit_medians
+    centered_z = z_abs[in_units] - unit_medians[unit_ix]
+
+    # convert them to bin identities by adding half the bin size and
+    # floor dividing by the bin size
+    # this corresponds to bins like:
+    #      ... | bin -1 | bin 0 | bin 1 | ...
+    #   ... -3bin/2 , -bin/2, bin/2, 3bin/2, ...
+    bin_ids = np.floor_divide(
+        centered_z + bin_size_um / 2, bin_size_um
+    ).astype(np.int32)
+    if units_spread is not None:
+        # np.abs(bin_ids) <= (np.abs(centered_z)+ bin_size_um / 2)//bin_size_um <= (max_z_dist + bin_size_um / 2)//bin_size_um
+        in_spread = np.abs(bin_ids) <= (
+            units_spread[unit_labels[unit_ix]] + bin_size_um / 2
+        ) // bin_size_um
+        in_units = in_units[in_spread]
+        unit_ix = unit_ix[in_spread]
+        bin_ids = bin_ids[in_spread]
+
+    # one superres label per occupied (unit, bin) pair, ordered by unit
+    # and then by bin. the keys are small non-negative integers, so
+    # bincount does the job of np.unique in linear time
+    # (initial=0 covers the case where units_spread leaves no spikes)
+    bin_min = bin_ids.min(initial=0)
+    n_bins = int(bin_ids.max(initial=0) - bin_min) + 1
+    unit_bin_keys = unit_ix * n_bins + (bin_ids - bin_min)
+    key_counts = np.bincount(unit_bin_keys)
+    occupied = key_counts > 0
+    occupied_keys = np.flatnonzero(occupied)
+    n_spikes_per_bin = key_counts[occupied_keys]
+    superres_ix = (np.cumsum(occupied) - 1)[unit_bin_keys]
+    superres_labels[in_units] = superres_ix
+    superres_label_to_bin_id = (occupied_keys % n_bins + bin_min).astype(np.int32)
+    superres_label_to_orig_label = unit_labels[occupied_keys // n_bins]
+
+    # max channel of each superres template: closest channel to the median
+    # position of its spikes
+    n_superres = occupied_keys.size
+    bin_x = grouped_median(x[in_units], superres_ix, n_superres)
+    bin_z = grouped_median(z_abs[in_units], superres_ix, n_superres)
+    unit_max_channels = cdist(
+        np.c_[bin_x, bin_z], geom, "sqeuclidean"
+    ).argmin(axis=1)
+
     return (
         superres_labels,
         superres_label_to_bin_id,
@@ -119,6 +130,61 @@ def superres_spike_train(
     )
 
 
+def grouped_median(values, groups, n_groups):
+    """Median of `values` within each group, for groups 0, ..., n_groups - 1
+
+    Every group is assumed to be non-empty.
+    """
+    counts = np.bincount(groups, minlength=n_groups)
+    lo, hi = _grouped_middle_values(values, groups, counts)
+    return (lo + hi) / 2
+
+
+@numba.jit(nopython=True, parallel=True, cache=True)
+def _grouped_middle_values(values, groups, counts):
+    # bucket the values by group with a counting sort, then sort each group
+    # in parallel and read off its middle value(s)
+    starts = np.zeros(counts.size + 1, dtype=np.int64)
+    starts[1:] = np.cumsum(counts)
+    grouped_values = np.empty_like(values)
+    fill = starts[:-1].copy()
+    for i in range(values.size):
+        grouped_values[fill[groups[i]]] = values[i]
+        fill[groups[i]] += 1
+
+    lo = np.empty(counts.size, dtype=values.dtype)
+    hi = np.empty(counts.size, dtype=values.dtype)
+    for g in numba.prange(counts.size):
+        group_values = np.sort(grouped_values[starts[g] : starts[g + 1]])
+        lo[g] = group_values[(counts[g] - 1) // 2]
+        hi[g] = group_values[counts[g] // 2]
+    return lo, hi
+
+
+def max_ptp(templates):
+    """templates.ptp(1).max(1), in one pass without the (N, C) temporary"""
+    return _max_ptp(np.ascontiguousarray(templates))
+
+
+@numba.jit(nopython=True, parallel=True, cache=True)
+def _max_ptp(templates):
+    n, t, c = templates.shape
+    out = np.empty(n, dtype=templates.dtype)
+    for i in numba.prange(n):
+        # running min / max over time for every channel, reading rows in order
+        mins = templates[i, 0].copy()
+        maxs = templates[i, 0].copy()
+        for j in range(1, t):
+            for k in range(c):
+                v = templates[i, j, k]
+                if v < mins[k]:
+                    mins[k] = v
+                if v > maxs[k]:
+                    maxs[k] = v
+        out[i] = (maxs - mins).max()
+    return out
+
+
 # %%
 
 # %%
@@ -153,6 +219,7 @@ def superres_denoised_templates(
     tpca_radius=75,
     tpca_n_wfs=50_000,
     tpca_centered=True,
+    tpca_use_eigh=False,
     do_nn_denoise=False,
     denoiser_init_kwargs={}, 
     denoiser_weights_path=None, 
@@ -205,6 +272,7 @@ def superres_denoised_templates(
         tpca_radius=tpca_radius,
         tpca_n_wfs=tpca_n_wfs,
         tpca_centered=tpca_centered,
+        tpca_use_eigh=tpca_use_eigh,
         use_previous_max_channels=True,
         do_nn_denoise=do_nn_denoise,
         denoiser_init_kwargs=denoiser_init_kwargs, 
@@ -253,45 +321,126 @@ def augment_low_snr_templates(
     
     pitch = get_pitch(geom)
     n_chans_per_row = (geom[:, 1]<pitch).sum()
+    # deconv works in float32, so there is no need to carry float64 here
+    superres_templates = superres_templates.astype(np.float32, copy=False)
     
     temp_to_augment = np.flatnonzero(n_spikes_per_bin<min_spikes_to_augment)
+    bins_per_pitch = int(pitch // bin_size_um)
+    # the channel maps of the two pitch shifts and the (unit, bin) -> superres
+    # label lookup are shared by all templates, so compute them once
+    shift_source_channels = {
+        shift: pitch_shift_channels(shift, geom) for shift in (-1, 1)
+    }
+    superres_label_lookup = {
+        key: j
+        for j, key in enumerate(
+            zip(superres_label_to_orig_label, superres_label_to_bin_id)
+        )
+    }
+    shifted_template = np.empty_like(superres_templates[0])
     for k in temp_to_augment:
         temp_orig = superres_label_to_orig_label[k]
         bin_id = superres_label_to_bin_id[k] 
-        bins_to_augment = np.array([bin_id+pitch//bin_size_um, bin_id-pitch//bin_size_um])
-        n_pitch_shifts = np.array([-1, 1])
-        idx_exist = np.isin(bins_to_augment, superres_label_to_bin_id[superres_label_to_orig_label==temp_orig])
-        n_pitch_shifts = n_pitch_shifts[idx_exist]
-        bins_to_augment = bins_to_augment[idx_exist] 
-        if len(bins_to_augment):
+        bins_to_augment = [bin_id+bins_per_pitch, bin_id-bins_per_pitch]
+        n_pitch_shifts = [-1, 1]
+        augment_from = [
+            (superres_label_lookup[temp_orig, bin_id_to_augment], shift)
+            for bin_id_to_augment, shift in zip(bins_to_augment, n_pitch_shifts)
+            if (temp_orig, bin_id_to_augment) in superres_label_lookup
+        ]
+        if len(augment_from):
             cmp = n_spikes_per_bin[k]
-            superres_templates[k] = superres_templates[k]*n_spikes_per_bin[k]
-            for j, bin_id_to_augment in enumerate(bins_to_augment):
-                shift = n_pitch_shifts[j]
-                idx_augment = np.flatnonzero(np.logical_and(superres_label_to_orig_label==temp_orig, superres_label_to_bin_id==bin_id_to_augment))
+            # weighted sum accumulated in place in the template's own row
+            template = superres_templates[k]
+            np.multiply(template, n_spikes_per_bin[k], out=template)
+            for idx_augment, shift in augment_from:
+                source_channels = shift_source_channels[shift]
+                has_source = source_channels >= 0
+                shifted_template.fill(fill_value)
+                shifted_template[:, has_source] = superres_templates[
+                    idx_augment, :, source_channels[has_source]
+                ].T
+                np.multiply(
+                    shifted_template, n_spikes_per_bin[idx_augment], out=shifted_template
+                )
+                template += shifted_template
                 if shift>0:
                     # shift by 1 row up
                     # set other channels ot 0
-                    superres_templates[k] += pitch_shift_templates(
-                                                shift, geom, superres_templates[idx_augment], fill_value=fill_value
-                                            )[0]*n_spikes_per_bin[idx_augment]
-                    superres_templates[k, :, :shift*n_chans_per_row]=0
+                    template[:, :shift*n_chans_per_row]=0
                 elif shift<0:
                     # shift by shift row down
                     # set other channels ot 0
-                    superres_templates[k] += pitch_shift_templates(
-                                                shift, geom, superres_templates[idx_augment], fill_value=fill_value
-                                            )[0]*n_spikes_per_bin[idx_augment]
-                    superres_templates[k, :, shift*n_chans_per_row:]=0
+                    template[:, shift*n_chans_per_row:]=0
                 cmp += n_spikes_per_bin[idx_augment]
             n_spikes_per_bin[k]=cmp
-            superres_templates[k] /= cmp
+            np.true_divide(template, cmp, out=template)
          
     return superres_templates, n_spikes_per_bin
     
 
 
 # %%
+def get_bins_per_pitch(pitch, bin_size_um):
+    bins_per_pitch = pitch / bin_size_um
+    
+    if bins_per_pitch != int(bins_per_pitch):
+        raise ValueError(
+            f"The pitch of this probe is {pitch}, but the bin size "
+            f"{bin_size_um} does not evenly divide it."
+        )
+    return int(bins_per_pitch)
+
+
+def superres_units_bins_shift(
+    superres_label_to_orig_label,
+    bin_size_um,
+    disp_value,
+    registered_medians,
+    medians_at_computation,
+):
+    """Group the superres labels by unit and get each unit's shift in bins
+
+    Returns order (None when superres_label_to_orig_label is sorted, as
+    superres_spike_train makes it, and then each unit is a slice), the
+    units, their start and end in the grouped labels, and the shifts.
+    """
+    if (np.diff(superres_label_to_orig_label) >= 0).all():
+        order = None
+        units, unit_starts = np.unique(
+            superres_label_to_orig_label, return_index=True
+        )
+    else:
+        order = np.argsort(superres_label_to_orig_label, kind="stable")
+        units, unit_starts = np.unique(
+            superres_label_to_orig_label[order], return_index=True
+        )
+    unit_ends = np.append(unit_starts[1:], len(superres_label_to_orig_label))
+
+    shift_um = disp_value + registered_medians[units] - medians_at_computation[units]
+    # shift in bins, rounded towards 0
+    units_bins_shift = np.round(shift_um / bin_size_um).astype(np.int32) # ROUND ??? - do mod, a little different
+    return order, units, unit_starts, unit_ends, units_bins_shift
+
+
+def mod_shift_index(unit_bin_ids, bins_shift_rem, bins_per_pitch, pitch):
+    """Indices of the templates of a unit which move by a pitch in its mod shift
+
+    None if the unit is not mod shifted.
+    """
+    # IDEA: take the bottom bin and shift it above - 
+    # If more than pitch/2 templates - OK, can shift 
+    # Only special case np.abs(bins_shift_rem)<=pitch/2 and n_temp <=pitch/2 -> better not to shift (no information gain)
+    n_temp = len(unit_bin_ids)
+    if bins_shift_rem<0:
+        if bins_shift_rem<-pitch/2 or n_temp>pitch/2:
+            return np.flatnonzero(np.isin(unit_bin_ids, unit_bin_ids.min()-np.arange(-bins_shift_rem)+bins_per_pitch-1))
+    elif bins_shift_rem>0:
+        if bins_shift_rem>pitch/2 or n_temp>pitch/2:
+            return np.flatnonzero(np.isin(unit_bin_ids, unit_bin_ids.max()+np.arange(bins_shift_rem)-bins_per_pitch+1))
+    return None
+
+
 def shift_superres_templates(
     superres_templates,
     superres_label_to_bin_id,
@@ -302,81 +451,141 @@ def shift_superres_templates(
     registered_medians,
     medians_at_computation,
     fill_value=0.0,
+    pitch_shift_cache=None,
+    pitch=None,
 ):
 
     """
     This version shifts by every (possible - if enough templates) mod 
+
+    superres_label_to_bin_id is updated in place, see shift_superres_bin_ids
+
+    pitch_shift_cache is an optional dict mapping a number of pitches to its
+    pitch_shift_channels result, to be shared across calls with the same geom
+    (as is pitch, which is computed from geom if not given)
     """
-    pitch = get_pitch(geom)
-    bins_per_pitch = pitch / bin_size_um
+    if pitch is None:
+        pitch = get_pitch(geom)
+    bins_per_pitch = get_bins_per_pitch(pitch, bin_size_um)
     
-    if bins_per_pitch != int(bins_per_pitch):
-        raise ValueError(
-            f"The pitch of this probe is {pitch}, but the bin size "
-            f"{bin_size_um} does not evenly divide it."
-        )
-    
-    shifted_templates = superres_templates.copy()
+    if pitch_shift_cache is None:
+        pitch_shift_cache = {}
+    # deconv works in float32, so there is no need to carry float64 here
+    superres_templates = superres_templates.astype(np.float32, copy=False)
+
+    # group the superres templates by unit once, rather than scanning
+    # superres_label_to_orig_label for every unit
+    order, units, unit_starts, unit_ends, units_bins_shift = superres_units_bins_shift(
+        superres_label_to_orig_label, bin_size_um, disp_value, registered_medians, medians_at_computation
+    )
+
+    # only the templates of shifted units change, so copy the others over
+    # once instead of copying the whole bank and then overwriting. the
+    # result is always a new array, even if nothing moves
+    is_shifted = units_bins_shift != 0
+    if not is_shifted.any():
+        return superres_templates.copy()
+    shifted_templates = np.empty_like(superres_templates)
+    unchanged = ~np.isin(superres_label_to_orig_label, units[is_shifted])
+    shifted_templates[unchanged] = superres_templates[unchanged]
 
     #shift every unit separately
-    for unit in np.unique(superres_label_to_orig_label):
-        shift_um = disp_value + registered_medians[unit] - medians_at_computation[unit]
-        # shift in bins, rounded towards 0
-        bins_shift = np.round(shift_um / bin_size_um) # ROUND ??? - do mod, a little different
-        if bins_shift!=0:
-            # How to do the shifting?
-            # We break the shift into two pieces: the number of full pitches,
-            # and the remaining bins after shifting by full pitches.
-            n_pitches_shift = int(
-                bins_shift / bins_per_pitch
-            )  # want to round towards 0, not //
-
-            bins_shift_rem = bins_shift - bins_per_pitch * n_pitches_shift
-
-            # Now, first we do the pitch shifts
-            shifted_templates_unit = pitch_shift_templates(
-                n_pitches_shift, geom, superres_templates[superres_label_to_orig_label==unit], fill_value=fill_value
-            )
-            # Now, do the mod shift bins_shift_rem
-            # IDEA: take the bottom bin and shift it above - 
-            # If more than pitch/2 templates - OK, can shift 
-            # Only special case np.abs(bins_shift_rem)<=pitch/2 and n_temp <=pitch/2 -> better not to shift (no information gain)
-
-            n_temp = (superres_label_to_orig_label==unit).sum()
-            if bins_shift_rem<0:
-                if bins_shift_rem<-pitch/2 or n_temp>pitch/2:
-                    idx_mod_shift = np.flatnonzero(np.isin(superres_label_to_bin_id[superres_label_to_orig_label==unit], superres_label_to_bin_id[superres_label_to_orig_label==unit].min()-np.arange(-bins_shift_rem)+bins_per_pitch-1))
-                    n_temp_shift = len(idx_mod_shift)
-                    if n_temp_shift:
-                        shifted_templates_unit[-n_temp_shift:] = pitch_shift_templates(
-                            -1, geom, shifted_templates_unit[idx_mod_shift], fill_value=fill_value
-                        ) 
-
-                        # The rest of the shift is handled by updating bin ids
-                        # This part doesn't matter for the recovered spike train, since
-                        # the template doesn't change, but it could matter for z tracking
-                        superres_label_to_bin_id[superres_label_to_orig_label==unit] = np.roll(superres_label_to_bin_id[superres_label_to_orig_label==unit], -len(idx_mod_shift))
-            elif bins_shift_rem>0:
-                if bins_shift_rem>pitch/2 or n_temp>pitch/2:
-                    idx_mod_shift = np.flatnonzero(np.isin(superres_label_to_bin_id[superres_label_to_orig_label==unit], superres_label_to_bin_id[superres_label_to_orig_label==unit].max()+np.arange(bins_shift_rem)-bins_per_pitch+1))
-                    n_temp_shift = len(idx_mod_shift)
-                    if n_temp_shift:
-                        shifted_templates_unit[:n_temp_shift] = pitch_shift_templates(
-                            1, geom, shifted_templates_unit[idx_mod_shift], fill_value=fill_value
-                        ) #shift by 1 pitch as we taked templates that are at max()+shift-pitch
-                        # update bottom templates - we remove <= "space" at the bottom than we add on top
-
-                        # The rest of the shift is handled by updating bin ids
-                        # This part doesn't matter for the recovered spike train, since
-                        # the template doesn't change, but it could matter for z tracking
-
-                        # !!! That's an approximation - maybe we'll need to change if we do z tracking, shoul;d be fine for now - is ok if we have bins that are "continuous" per unit
-                        superres_label_to_bin_id[superres_label_to_orig_label==unit] = np.roll(superres_label_to_bin_id[superres_label_to_orig_label==unit], n_temp_shift)
-            shifted_templates[superres_label_to_orig_label==unit]=shifted_templates_unit
+    for start, end, bins_shift in zip(
+        unit_starts[is_shifted], unit_ends[is_shifted], units_bins_shift[is_shifted]
+    ):
+        in_unit = slice(start, end) if order is None else order[start:end]
+        unit_bin_ids = superres_label_to_bin_id[in_unit]
+        # How to do the shifting?
+        # We break the shift into two pieces: the number of full pitches,
+        # and the remaining bins after shifting by full pitches.
+        n_pitches_shift = int(
+            bins_shift / bins_per_pitch
+        )  # want to round towards 0, not //
+
+        bins_shift_rem = bins_shift - bins_per_pitch * n_pitches_shift
+
+        # Now, first we do the pitch shifts
+        # (written to the output first, since with a slice in_unit and no
+        # pitch shift this would be a view of the input bank)
+        shifted_templates[in_unit] = pitch_shift_templates(
+            n_pitches_shift, geom, superres_templates[in_unit], fill_value=fill_value,
+            source_channels=cached_pitch_shift_channels(n_pitches_shift, geom, pitch_shift_cache),
+        )
+        shifted_templates_unit = shifted_templates[in_unit]
+        # Now, do the mod shift bins_shift_rem
+        idx_mod_shift = mod_shift_index(unit_bin_ids, bins_shift_rem, bins_per_pitch, pitch)
+        n_temp_shift = 0 if idx_mod_shift is None else len(idx_mod_shift)
+        if bins_shift_rem<0 and n_temp_shift:
+            shifted_templates_unit[-n_temp_shift:] = pitch_shift_templates(
+                -1, geom, shifted_templates_unit[idx_mod_shift], fill_value=fill_value,
+                source_channels=cached_pitch_shift_channels(-1, geom, pitch_shift_cache),
+            ) 
+
+            # The rest of the shift is handled by updating bin ids
+            # This part doesn't matter for the recovered spike train, since
+            # the template doesn't change, but it could matter for z tracking
+            superres_label_to_bin_id[in_unit] = np.roll(unit_bin_ids, -n_temp_shift)
+        elif bins_shift_rem>0 and n_temp_shift:
+            shifted_templates_unit[:n_temp_shift] = pitch_shift_templates(
+                1, geom, shifted_templates_unit[idx_mod_shift], fill_value=fill_value,
+                source_channels=cached_pitch_shift_channels(1, geom, pitch_shift_cache),
+            ) #shift by 1 pitch as we taked templates that are at max()+shift-pitch
+            # update bottom templates - we remove <= "space" at the bottom than we add on top
+
+            # The rest of the shift is handled by updating bin ids
+            # This part doesn't matter for the recovered spike train, since
+            # the template doesn't change, but it could matter for z tracking
+
+            # !!! That's an approximation - maybe we'll need to change if we do z tracking, shoul;d be fine for now - is ok if we have bins that are "continuous" per unit
+            superres_label_to_bin_id[in_unit] = np.roll(unit_bin_ids, n_temp_shift)
+        if order is not None:
+            shifted_templates[in_unit]=shifted_templates_unit
 
     return shifted_templates #, superres_label_to_bin_id
 
 
+def shift_superres_bin_ids(
+    superres_label_to_bin_id,
+    superres_label_to_orig_label,
+    bin_size_um,
+    geom,
+    disp_value,
+    registered_medians,
+    medians_at_computation,
+    pitch=None,
+):
+    """The in place bin id update of shift_superres_templates, on its own
+
+    Each call starts from the bin ids left by the previous one, so
+    shift_deconv runs these in order and then shifts the templates in
+    parallel, each shift from its own copy of the bin ids.
+    """
+    if pitch is None:
+        pitch = get_pitch(geom)
+    bins_per_pitch = get_bins_per_pitch(pitch, bin_size_um)
+    order, units, unit_starts, unit_ends, units_bins_shift = superres_units_bins_shift(
+        superres_label_to_orig_label, bin_size_um, disp_value, registered_medians, medians_at_computation
+    )
+    is_shifted = units_bins_shift != 0
+    for start, end, bins_shift in zip(
+        unit_starts[is_shifted], unit_ends[is_shifted], units_bins_shift[is_shifted]
+    ):
+        in_unit = slice(start, end) if order is None else order[start:end]
+        unit_bin_ids = superres_label_to_bin_id[in_unit]
+        bins_shift_rem = bins_shift - bins_per_pitch * int(bins_shift / bins_per_pitch)
+        idx_mod_shift = mod_shift_index(unit_bin_ids, bins_shift_rem, bins_per_pitch, pitch)
+        if idx_mod_shift is not None and len(idx_mod_shift):
+            superres_label_to_bin_id[in_unit] = np.roll(
+                unit_bin_ids, np.sign(bins_shift_rem) * len(idx_mod_shift)
+            )
+
+
+def cached_pitch_shift_channels(n_pitches_shift, geom, cache):
+    if n_pitches_shift not in cache:
+        cache[n_pitches_shift] = pitch_shift_channels(n_pitches_shift, geom)
+    return cache[n_pitches_shift]
+
+
 # %%
 def shift_deconv(
     raw_bin,
@@ -412,26 +621,59 @@ def shift_deconv(
 
     # integer probe-pitch shifts at each time bin
     p = p[t_start : t_end if t_end is not None else len(p)]
-    bin_shifts = (p + bin_size_um / 2) // bin_size_um * bin_size_um
+    # (p + bin_size_um / 2) // bin_size_um * bin_size_um, without temporaries
+    bin_shifts = np.add(p, bin_size_um / 2)
+    np.floor_divide(bin_shifts, bin_size_um, out=bin_shifts)
+    np.multiply(bin_shifts, bin_size_um, out=bin_shifts)
     unique_shifts, shift_ids_by_time = np.unique(
         bin_shifts, return_inverse=True
     )
 
     # for each shift, get shifted templates
-    shifted_templates = np.array(
-        [
-            shift_superres_templates(
-                superres_templates,
-                superres_label_to_bin_id,
-                superres_label_to_orig_label,
-                bin_size_um,
-                geom,
-                shift,
-                registered_medians,
-                medians_at_computation)
-            for shift in unique_shifts
-        ]
-    )
+    # the pitch shift channel maps only depend on the number of pitches, so
+    # they are shared across shifts. the shifts are independent, and threads
+    # share the (large) template bank rather than copying it to workers
+    # (cast once here rather than in every shift_superres_templates call)
+    superres_templates = superres_templates.astype(np.float32, copy=False)
+    # every shift may use the +-1 maps for its mod shifts, so fill them in
+    # before the threads start
+    pitch_shift_cache = {
+        n_pitches: pitch_shift_channels(n_pitches, geom) for n_pitches in (-1, 1)
+    }
+    # the mod shifts update superres_label_to_bin_id in place, and each
+    # shift sees the bin ids left by the ones before it. that part is cheap,
+    # so run it in order here and give each shift a copy of its bin ids
+    shift_bin_ids = []
+    for shift in unique_shifts:
+        shift_bin_ids.append(superres_label_to_bin_id.copy())
+        shift_superres_bin_ids(
+            superres_label_to_bin_id,
+            superres_label_to_orig_label,
+            bin_size_um,
+            geom,
+            shift,
+            registered_medians,
+            medians_at_computation,
+            pitch=pitch,
+        )
+    with Parallel(n_processors, require="sharedmem") as pool:
+        shifted_templates = np.stack(
+            pool(
+                delayed(shift_superres_templates)(
+                    superres_templates,
+                    bin_ids,
+                    superres_label_to_orig_label,
+                    bin_size_um,
+                    geom,
+                    shift,
+                    registered_medians,
+                    medians_at_computation,
+                    pitch_shift_cache=pitch_shift_cache,
+                    pitch=pitch,
+                )
+                for shift, bin_ids in zip(unique_shifts, shift_bin_ids)
+            )
+        )
 
     # run deconv on just the appropriate batches for each shift
     deconv_dir = Path(
@@ -515,61 +757,68 @@ def shift_deconv(
     )
     assert shifted_upsampled_idx_to_shift_id.shape == shifted_upsampled_idx_to_orig_id.shape
 
-    # gather deconv resultsdeconv_st = []
-    deconv_spike_train_shifted_upsampled = []
-    deconv_spike_train = []
-    deconv_scalings = []
-    deconv_dist_metrics = []
+    # gather deconv results
+    # reading the batch files is IO bound, so use threads for it. the
+    # bookkeeping below is done once on the concatenated results
     print("gathering deconvolution results")
-    for bid in range(mp_object.n_batches):
-        which_shiftix = batch2shiftix[bid]
-
-        fname_out = deconv_dir / f"seg_{bid:06d}_deconv.npz"
-        with np.load(fname_out) as d:
-            st = d["spike_train"]
-            deconv_scalings.append(d["scalings"])
-            deconv_dist_metrics.append(d["dist_metric"])
-
-        st[:, 0] += trough_offset
-
-        # usual spike train
-        deconv_st = st.copy()
-        deconv_st[:, 1] //= max_upsample
-        deconv_spike_train.append(deconv_st)
-
-        # upsampled + shifted spike train
-        st_up = st.copy()
-        st_up[:, 1] = shifted_sparse_temp_map[which_shiftix][st_up[:, 1]]
-        st_up[:, 1] += shifted_upsampled_start_ixs[which_shiftix]
-        deconv_spike_train_shifted_upsampled.append(st_up)
-
-        shift_good = (
-            shifted_upsampled_idx_to_shift_id[st_up[:, 1]] == which_shiftix
-        ).all()
-        tsorted = (np.diff(st_up[:, 0]) >= 0).all()
-        bigger = (bid == 0) or (
-            st_up[:, 0] >= deconv_spike_train_shifted_upsampled[-2][:, 0].max()
-        ).all()
-        pitchy = (
-            bin_shifts[((st_up[:, 0] - trough_offset) // pfs - t_start).astype(int)] == unique_shifts[which_shiftix]
-        ).all()
-        # print(f"{bid=} {shift_good=} {tsorted=} {bigger=} {pitchy=}")
-        assert shift_good
-        assert tsorted
-        assert bigger
-        if not pitchy:
-            raise ValueError(
-                f"{bid=} Not pitchy {np.unique(bin_shifts[((st_up[:, 0] - trough_offset) // pfs - t_start).astype(int)])=} "
-                f"{which_shiftix=} {unique_shifts[which_shiftix]=} {np.unique((st_up[:, 0] - trough_offset) // pfs - t_start)=} "
-                f"{bin_shifts[np.unique((st_up[:, 0] - trough_offset) // pfs - t_start)]=}"
-            )
+    fnames_out = [
+        deconv_dir / f"seg_{bid:06d}_deconv.npz"
+        for bid in range(mp_object.n_batches)
+    ]
+    with ThreadPoolExecutor(n_processors) as pool:
+        batch_results = list(pool.map(load_deconv_batch_result, fnames_out))
+    batch_spike_trains, batch_scalings, batch_dist_metrics = zip(
+        *batch_results
+    )
+    st = np.concatenate(batch_spike_trains, axis=0)
+    deconv_scalings = np.concatenate(batch_scalings, axis=0)
+    deconv_dist_metrics = np.concatenate(batch_dist_metrics, axis=0)
+    spike_batch_ids = np.repeat(
+        np.arange(mp_object.n_batches),
+        [len(bst) for bst in batch_spike_trains],
+    )
+    batch_shiftixs = np.array(
+        [batch2shiftix[bid] for bid in range(mp_object.n_batches)]
+    )
+    spike_shiftixs = batch_shiftixs[spike_batch_ids]
+
+    st[:, 0] += trough_offset
 
-    deconv_spike_train = np.concatenate(deconv_spike_train, axis=0)
-    deconv_spike_train_shifted_upsampled = np.concatenate(
-        deconv_spike_train_shifted_upsampled, axis=0
+    # usual spike train
+    deconv_spike_train = st.copy()
+    deconv_spike_train[:, 1] //= max_upsample
+
+    # upsampled + shifted spike train
+    sparse_temp_map_starts = np.cumsum(
+        [0] + [len(m) for m in shifted_sparse_temp_map[:-1]]
+    )
+    all_sparse_temp_maps = np.concatenate(shifted_sparse_temp_map)
+    deconv_spike_train_shifted_upsampled = st.copy()
+    deconv_spike_train_shifted_upsampled[:, 1] = (
+        all_sparse_temp_maps[sparse_temp_map_starts[spike_shiftixs] + st[:, 1]]
+        + shifted_upsampled_start_ixs[spike_shiftixs]
     )
-    deconv_scalings = np.concatenate(deconv_scalings, axis=0)
-    deconv_dist_metrics = np.concatenate(deconv_dist_metrics, axis=0)
+    st_up = deconv_spike_train_shifted_upsampled
+
+    shift_good = (
+        shifted_upsampled_idx_to_shift_id[st_up[:, 1]] == spike_shiftixs
+    ).all()
+    # checked on the whole train, this covers both the sorting within each
+    # batch and each batch starting after the previous one
+    tsorted = (np.diff(st_up[:, 0]) >= 0).all()
+    spike_secs = ((st_up[:, 0] - trough_offset) // pfs - t_start).astype(int)
+    not_pitchy = bin_shifts[spike_secs] != unique_shifts[spike_shiftixs]
+    assert shift_good
+    assert tsorted
+    if not_pitchy.any():
+        bid = spike_batch_ids[np.flatnonzero(not_pitchy)[0]]
+        which_shiftix = batch_shiftixs[bid]
+        batch_secs = spike_secs[spike_batch_ids == bid]
+        raise ValueError(
+            f"{bid=} Not pitchy {np.unique(bin_shifts[batch_secs])=} "
+            f"{which_shiftix=} {unique_shifts[which_shiftix]=} {np.unique(batch_secs)=} "
+            f"{bin_shifts[np.unique(batch_secs)]=}"
+        )
 
     print(
         f"Number of Spikes deconvolved: {deconv_spike_train_shifted_upsampled.shape[0]}"
@@ -586,6 +835,11 @@ def shift_deconv(
         deconv_dist_metrics=deconv_dist_metrics,
     )
 
+
+def load_deconv_batch_result(fname):
+    with np.load(fname) as d:
+        return d["spike_train"], d["scalings"], d["dist_metric"]
+
 # %%
 def superres_deconv_chunk(
     raw_bin,
@@ -843,10 +1097,20 @@ def extract_superres_shifted_deconv(
             "bin_size_um",
             "deconv_dist_metrics",
         ):
-            h5.create_dataset(key, data=superres_deconv_result[key])
+            write_h5_dataset(h5, key, superres_deconv_result[key])
 
     return extract_h5
 
+
+def write_h5_dataset(h5, name, data):
+    """Store an array as a new contiguous dataset with one H5Dwrite"""
+    data = np.asarray(data)
+    if data.ndim == 0 or data.size == 0 or data.dtype.kind not in "biuf":
+        return h5.create_dataset(name, data=data)
+    dset = h5.create_dataset(name, shape=data.shape, dtype=data.dtype)
+    dset.write_direct(np.ascontiguousarray(data))
+    return dset
+
 # %%
 
 
@@ -891,23 +1155,33 @@ def full_deconv_with_update(
     save_chunk_results=False,
 ):
 
-    Path(extract_dir).mkdir(exist_ok=True)
+    extract_dir = Path(extract_dir)
+    extract_dir.mkdir(exist_ok=True)
 
     registered_medians, units_spread = get_registered_pos(spike_train, z, p, pfs)
     
-    fname_medians = Path(extract_dir) / "registered_medians.npy"
-    fname_spread = Path(extract_dir) / "registered_spreads.npy"
+    fname_medians = extract_dir / "registered_medians.npy"
+    fname_spread = extract_dir / "registered_spreads.npy"
     np.save(fname_spread, units_spread)
     np.save(fname_medians, registered_medians)
 
+    if save_chunk_results:
+        fname_chunk_results = extract_dir / "chunk_results_deconv.h5"
+        with h5py.File(fname_chunk_results, "w") as h5:
+            append_to_h5_dataset(h5, "chunk_offsets", [0], chunk_rows=256)
+
     if adaptive_th_for_temp_computation:
         outliers_tracking = np.ones(len(spike_train), dtype=bool)
-        dist_metric = deconv_th_for_temp_computation*2*np.ones(len(spike_train))
+        dist_metric = np.full(len(spike_train), deconv_th_for_temp_computation*2, dtype=np.float32)
 
     elif deconv_th_for_temp_computation is not None:
         outliers_tracking = None
-        dist_metric = deconv_th_for_temp_computation*2*np.ones(len(spike_train))
+        dist_metric = np.full(len(spike_train), deconv_th_for_temp_computation*2, dtype=np.float32)
 
+    # the chunk results are read into buffers reused across chunks. this is
+    # safe since update_spike_train_with_deconv_res copies what it keeps
+    # and the chunk results writes are done before the next read
+    chunk_buffers = {}
     for start_sec in tqdm(np.arange(T_START, T_END, n_sec_temp_update)):
         end_sec = min(start_sec+n_sec_temp_update, T_END)
 
@@ -962,34 +1236,39 @@ def full_deconv_with_update(
             n_jobs=n_jobs,
         )
 
-        with h5py.File(extract_deconv_chunk, "r+") as h5:
-            spt_chunk = h5["deconv_spike_train"][:]
-            maxptps_chunk = h5["maxptps"][:]
-            localizations_chunk = h5["localizations"][:]
-            dist_metric_chunk = h5["deconv_dist_metrics"][:]
+        with h5py.File(extract_deconv_chunk, "r") as h5:
+            spt_chunk = read_h5_dataset(h5["deconv_spike_train"], chunk_buffers)
+            maxptps_chunk = read_h5_dataset(h5["maxptps"], chunk_buffers)
+            localizations_chunk = read_h5_dataset(h5["localizations"], chunk_buffers)
+            dist_metric_chunk = read_h5_dataset(h5["deconv_dist_metrics"], chunk_buffers)
             if adaptive_th_for_temp_computation:
-                superres_templates_chunk = h5["superres_templates"][:]
-                superres_deconv_spike_train_chunk = h5["superres_deconv_spike_train"][:]
+                superres_templates_chunk = read_h5_dataset(h5["superres_templates"], chunk_buffers)
+                superres_deconv_spike_train_chunk = read_h5_dataset(h5["superres_deconv_spike_train"], chunk_buffers)
                 superres_label = superres_deconv_spike_train_chunk[:, 1]
-                ptps_temp_spikes = superres_templates_chunk.ptp(1).max(1)[superres_label]
-                outliers_tracking_chunk = dist_metric_chunk > (p[0] + p[1]*ptps_temp_spikes + p[2]*ptps_temp_spikes**2 + p[3]*ptps_temp_spikes**3) 
+                ptps_temps = max_ptp(superres_templates_chunk)
+                ptps_temp_spikes = ptps_temps[superres_label]
+                # threshold is a polynomial in the template ptp, so evaluate it
+                # once per template (Horner's scheme) rather than per spike.
+                # the coefficients are p[0] + p[1]*ptp + p[2]*ptp**2 + p[3]*ptp**3
+                thresholds_temps = np.polyval(np.asarray(p[:4])[::-1], ptps_temps)
+                outliers_tracking_chunk = dist_metric_chunk > thresholds_temps[superres_label]
             else:
                 outliers_tracking_chunk=None
                 
         if save_chunk_results:
-            fname_ptps = Path(extract_dir) / "maxptps_deconv_{}_{}".format(start_sec, end_sec)
-            fname_spike_train = Path(extract_dir) / "spike_train_deconv_{}_{}".format(start_sec, end_sec)
-            fname_localizations = Path(extract_dir) / "localizations_deconv_{}_{}".format(start_sec, end_sec)
-            fname_dist_metric = Path(extract_dir) / "dist_metric_deconv_{}_{}".format(start_sec, end_sec)
-
-            np.save(fname_ptps, maxptps_chunk)
-            np.save(fname_spike_train, spt_chunk)
-            np.save(fname_localizations, localizations_chunk)
-            np.save(fname_dist_metric, dist_metric_chunk)
-            
-            if adaptive_th_for_temp_computation:
-                fname_ptps_spikes_temps = Path(extract_dir) / "ptps_temp_before_deconv_{}_{}".format(start_sec, end_sec)
-                np.save(fname_ptps_spikes_temps, ptps_temp_spikes)
+            # all chunks are appended to the same resizable datasets; chunk i
+            # spans chunk_offsets[i]:chunk_offsets[i+1]
+            with h5py.File(fname_chunk_results, "a") as h5:
+                n_saved = h5["chunk_offsets"][-1]
+                append_to_h5_dataset(h5, "chunk_start_sec", [start_sec], chunk_rows=256)
+                append_to_h5_dataset(h5, "chunk_end_sec", [end_sec], chunk_rows=256)
+                append_to_h5_dataset(h5, "chunk_offsets", [n_saved + len(spt_chunk)], chunk_rows=256)
+                append_to_h5_dataset(h5, "maxptps_deconv", maxptps_chunk)
+                append_to_h5_dataset(h5, "spike_train_deconv", spt_chunk)
+                append_to_h5_dataset(h5, "localizations_deconv", localizations_chunk)
+                append_to_h5_dataset(h5, "dist_metric_deconv", dist_metric_chunk)
+                if adaptive_th_for_temp_computation:
+                    append_to_h5_dataset(h5, "ptps_temp_before_deconv", ptps_temp_spikes)
 
         
         spike_train, x, z, dist_metric, maxptps, outliers_tracking = update_spike_train_with_deconv_res(start_sec, end_sec, 
@@ -1001,11 +1280,11 @@ def full_deconv_with_update(
                                                             pfs, adaptive_th_for_temp_computation)
     
     # SAVE FULL RESULT 
-    fname_ptps = Path(extract_dir) / "maxptps_final_deconv"
-    fname_spike_train = Path(extract_dir) / "spike_train_final_deconv"
-    fname_x = Path(extract_dir) / "x_final_deconv"
-    fname_z = Path(extract_dir) / "z_final_deconv"
-    fname_dist_metric = Path(extract_dir) / "dist_metric_final_deconv"
+    fname_ptps = extract_dir / "maxptps_final_deconv"
+    fname_spike_train = extract_dir / "spike_train_final_deconv"
+    fname_x = extract_dir / "x_final_deconv"
+    fname_z = extract_dir / "z_final_deconv"
+    fname_dist_metric = extract_dir / "dist_metric_final_deconv"
 
     np.save(fname_ptps, maxptps)
     np.save(fname_spike_train, spike_train)
@@ -1014,13 +1293,66 @@ def full_deconv_with_update(
     np.save(fname_dist_metric, dist_metric)
     
     if adaptive_th_for_temp_computation:
-        fname_outlier_tracking = Path(extract_dir) / "outliers_final_deconv"
+        fname_outlier_tracking = extract_dir / "outliers_final_deconv"
         np.save(fname_outlier_tracking, outliers_tracking)
 
 
 # %%
 
 # %%
+def append_to_h5_dataset(h5, name, data, chunk_rows=None, chunk_nbytes=1024 * 1024):
+    """Append data along the first axis of h5[name], creating it if needed
+
+    The dataset is created resizable, with HDF5 chunks of chunk_rows rows,
+    by default as many as fit in chunk_nbytes. This does not depend on the
+    size of the first append, which can be empty. Small metadata arrays
+    should pass a small chunk_rows.
+    """
+    data = np.asarray(data)
+    if name not in h5:
+        if chunk_rows is None:
+            row_nbytes = data.dtype.itemsize * int(np.prod(data.shape[1:]))
+            chunk_rows = max(1, chunk_nbytes // max(1, row_nbytes))
+        h5.create_dataset(
+            name,
+            shape=(0, *data.shape[1:]),
+            chunks=(chunk_rows, *data.shape[1:]),
+            maxshape=(None, *data.shape[1:]),
+            dtype=data.dtype,
+        )
+    dset = h5[name]
+    n = dset.shape[0]
+    dset.resize(n + len(data), axis=0)
+    dset[n:] = data
+
+
+def read_h5_dataset(dset, buffers=None):
+    """Read a whole dataset with one H5Dread into a preallocated array
+
+    If a dict of buffers is given, the read goes into the buffer kept there
+    under the dataset's name, which grows as needed, and a view of its
+    first rows is returned. That view is overwritten by the next read of a
+    dataset with the same name into these buffers.
+    """
+    if buffers is None or not dset.shape:
+        out = np.empty(dset.shape, dtype=dset.dtype)
+    else:
+        n = dset.shape[0]
+        buffer = buffers.get(dset.name)
+        if (
+            buffer is None
+            or buffer.dtype != dset.dtype
+            or buffer.shape[1:] != dset.shape[1:]
+            or len(buffer) < n
+        ):
+            # some headroom, since later chunks are often a bit larger
+            buffer = np.empty((n + n // 4, *dset.shape[1:]), dtype=dset.dtype)
+            buffers[dset.name] = buffer
+        out = buffer[:n]
+    if out.size:
+        dset.read_direct(out)
+    return out
+
 
 # %%
 def update_spike_train_with_deconv_res(start_sec, end_sec, spt_before, spt_after,
@@ -1035,50 +1367,117 @@ def update_spike_train_with_deconv_res(start_sec, end_sec, spt_before, spt_after
     x_after = localizations_after[:, 0]
     z_after = localizations_after[:, 2]
     
-    idx_units_to_add = np.flatnonzero(np.logical_and(spt_before[:, 0]>=start_sec*pfs, spt_before[:, 0]<end_sec*pfs))
-    units_to_add = np.setdiff1d(np.unique(spt_before[idx_units_to_add, 1]), np.unique(spt_after[:, 1]))
-    
-    idx_before = np.flatnonzero(np.logical_or(spt_before[:, 0]<start_sec*pfs, spt_before[:, 0]>=end_sec*pfs))
-    spt_after = np.concatenate((spt_before[idx_before], spt_after))
-    x_after = np.concatenate((x_before[idx_before], x_after))
-    z_after = np.concatenate((z_before[idx_before], z_after))
-    dist_metric_after = np.concatenate((dist_metric_before[idx_before], dist_metric_after))
-    maxptps_after = np.concatenate((maxptps_before[idx_before], maxptps_after))
-    if adaptive_th_for_temp_computation:
-        outliers_tracking_chunk = np.concatenate((outliers_tracking[idx_before], outliers_tracking_chunk))
-    
-    for unit in units_to_add:
-        idx_unit = idx_units_to_add[spt_before[idx_units_to_add, 1]==unit]
-        spt_after = np.concatenate((spt_before[idx_unit], spt_after))
-        x_after = np.concatenate((x_before[idx_unit], x_after))
-        z_after = np.concatenate((z_before[idx_unit], z_after))
-        dist_metric_after = np.concatenate((dist_metric_before[idx_unit], dist_metric_after))
-        maxptps_after = np.concatenate((maxptps_before[idx_unit], maxptps_after))
-        if adaptive_th_for_temp_computation:
-            outliers_tracking_chunk = np.concatenate((outliers_tracking[idx_unit], outliers_tracking_chunk))
-    
-    idx_sort_by_time = spt_after[:, 0].argsort()
-    x_after = x_after[idx_sort_by_time]
-    z_after = z_after[idx_sort_by_time]
-    dist_metric_after = dist_metric_after[idx_sort_by_time]
-    maxptps_after = maxptps_after[idx_sort_by_time]
-    spt_after = spt_after[idx_sort_by_time]
+    times_before = spt_before[:, 0]
+    before_sorted = (times_before[1:] >= times_before[:-1]).all()
+    if before_sorted:
+        # the spike train is time sorted after the first update, and then
+        # the chunk is a contiguous range
+        lo, hi = np.searchsorted(times_before, [start_sec*pfs, end_sec*pfs])
+        idx_units_to_add = np.arange(lo, hi)
+        idx_before = np.r_[0:lo, hi:len(times_before)]
+    else:
+        idx_units_to_add = np.flatnonzero(np.logical_and(times_before>=start_sec*pfs, times_before<end_sec*pfs))
+        idx_before = np.flatnonzero(np.logical_or(times_before<start_sec*pfs, times_before>=end_sec*pfs))
+    # spikes of the units that were not deconvolved in the chunk are kept.
+    # find those units with presence flags per label rather than sorting,
+    # then gather all the kept indices first and copy each array once
+    labels_window = spt_before[idx_units_to_add, 1]
+    labels_chunk = spt_after[:, 1]
+    min_label = min([0] + [labels.min() for labels in (labels_window, labels_chunk) if labels.size])
+    max_label = max([0] + [labels.max() for labels in (labels_window, labels_chunk) if labels.size])
+    in_window = np.zeros(max_label - min_label + 1, dtype=bool)
+    in_window[labels_window - min_label] = True
+    in_chunk = np.zeros_like(in_window)
+    in_chunk[labels_chunk - min_label] = True
+    unit_kept = in_window & ~in_chunk
+    idx_units_kept = idx_units_to_add[unit_kept[labels_window - min_label]]
+    times_chunk = spt_after[:, 0]
+    chunk_sorted = (times_chunk[1:] >= times_chunk[:-1]).all()
+    # usual case: nothing kept inside the window, and the chunk fits
+    # between the spikes before and after it
+    in_order = before_sorted and chunk_sorted and not idx_units_kept.size and (
+        not times_chunk.size
+        or (
+            (lo == 0 or times_before[lo - 1] <= times_chunk[0])
+            and (hi == len(times_before) or times_chunk[-1] < times_before[hi])
+        )
+    )
+    if in_order:
+        # then the result is just before + chunk + after, with no sorting
+        # or gathering at all
+        idx_kept = idx_sort_by_time = None
+    elif before_sorted and chunk_sorted:
+        # kept spikes in index order are time sorted, as is the chunk, so
+        # merge the two in linear time rather than argsorting everything:
+        # each chunk spike lands after the kept spikes up to its time
+        idx_kept = np.r_[0:lo, idx_units_kept, hi:len(times_before)]
+        n_kept = len(idx_kept)
+        chunk_positions = np.searchsorted(
+            times_before[idx_kept], times_chunk, side="right"
+        ) + np.arange(len(times_chunk))
+        from_chunk = np.zeros(n_kept + len(times_chunk), dtype=bool)
+        from_chunk[chunk_positions] = True
+        idx_sort_by_time = np.empty(len(from_chunk), dtype=np.intp)
+        idx_sort_by_time[~from_chunk] = np.arange(n_kept)
+        idx_sort_by_time[chunk_positions] = n_kept + np.arange(len(times_chunk))
+    else:
+        # (in decreasing unit order, as prepending unit by unit used to give)
+        idx_units_kept = idx_units_kept[np.argsort(-spt_before[idx_units_kept, 1], kind="stable")]
+        idx_kept = np.concatenate((idx_units_kept, idx_before))
+        idx_sort_by_time = np.concatenate((times_before[idx_kept], times_chunk)).argsort()
+
+    def combine(before, after):
+        if in_order:
+            return np.concatenate((before[:lo], after, before[hi:]))
+        return np.concatenate((before[idx_kept], after))[idx_sort_by_time]
+
+    spt_after = combine(spt_before, spt_after)
+    x_after = combine(x_before, x_after)
+    z_after = combine(z_before, z_after)
+    # metrics are only thresholded and saved, so float32 is plenty
+    dist_metric_after = combine(dist_metric_before, dist_metric_after).astype(np.float32, copy=False)
+    maxptps_after = combine(maxptps_before, maxptps_after).astype(np.float32, copy=False)
     if adaptive_th_for_temp_computation:
-        outliers_tracking_chunk = outliers_tracking_chunk[idx_sort_by_time]
+        outliers_tracking_chunk = combine(outliers_tracking, outliers_tracking_chunk)
 
-    return spt_after.astype('int'), x_after, z_after, dist_metric_after, maxptps_after, outliers_tracking_chunk
+    # times stay int64, since int32 sample indices overflow after ~20h at 30kHz
+    return spt_after.astype(np.int64, copy=False), x_after, z_after, dist_metric_after, maxptps_after, outliers_tracking_chunk
 
 
 # %%
 
 # %%
 def get_registered_pos(spt, z, displacement_rigid, pfs=30000):
-    z_reg = z-displacement_rigid[spt[:, 0]//pfs]
+    times = spt[:, 0]
+    # for time sorted spikes, the displacement is constant over runs of
+    # spikes in the same second, so repeat it over the runs rather than
+    # dividing and gathering per spike
+    if (
+        (times[1:] >= times[:-1]).all()
+        and times[0] >= 0
+        and times[-1] < len(displacement_rigid) * pfs
+    ):
+        sec_starts = np.searchsorted(times, np.arange(len(displacement_rigid) + 1) * pfs)
+        z_reg = z - np.repeat(displacement_rigid, np.diff(sec_starts))
+    else:
+        z_reg = z-displacement_rigid[times//pfs]
     registered_median = np.zeros(spt[:, 1].max()+1)
     registered_spread = np.zeros(spt[:, 1].max()+1)
-    for k in np.unique(spt[:, 1]):
-        registered_median[k] = np.median(z_reg[spt[:, 1]==k])
-        registered_spread[k] = np.std(z_reg[spt[:, 1]==k])*1.65
+
+    # group the spikes by unit in one pass, rather than a mask per unit.
+    # units without spikes keep 0s
+    labeled = spt[:, 1] >= 0
+    labels = spt[labeled, 1]
+    z_reg = z_reg[labeled]
+    counts = np.bincount(labels, minlength=registered_median.size)
+    units = np.flatnonzero(counts)
+    unit_ix = (np.cumsum(counts > 0) - 1)[labels]
+    counts = counts[units]
+
+    registered_median[units] = grouped_median(z_reg, unit_ix, units.size)
+    means = np.bincount(unit_ix, weights=z_reg) / counts
+    sq_devs = np.square(z_reg - means[unit_ix])
+    registered_spread[units] = np.sqrt(np.bincount(unit_ix, weights=sq_devs) / counts)*1.65
 
     return registered_median, registered_spread
 
@@ -2,7 +2,7 @@
 import numpy as np
 from tqdm.auto import tqdm
 import multiprocessing
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from .multiprocessing_utils import MockPoolExecutor, MockQueue
 import torch
 
@@ -29,6 +29,7 @@ def get_templates(
     tpca_rank=5,
     tpca_radius=75,
     tpca_n_wfs=50_000,
+    tpca_use_eigh=False,
     use_previous_max_channels=False,
     do_nn_denoise=False,
     denoiser_init_kwargs={}, 
@@ -127,6 +128,7 @@ def get_templates(
             device=device,
             batch_size=batch_size,
             seed=seed,
+            use_eigh=tpca_use_eigh,
         )
         extra["tpca"] = tpca
 
@@ -147,6 +149,11 @@ def get_templates(
     for id in range(n_jobs):
         id_queue.put(id)
 
+    # workers get a few chunks of units each, so that within a chunk they can
+    # read the next unit's waveforms while the current one is being reduced
+    unit_chunks = np.array_split(units, max(1, min(len(units), 8 * n_jobs)))
+    unit_chunks = [chunk for chunk in unit_chunks if chunk.size]
+
     with Executor(
         max_workers=n_jobs,
         mp_context=context,
@@ -173,7 +180,11 @@ def get_templates(
         ),
     ) as pool:
         for unit, raw_template, denoised_template, snr_by_chan in xqdm(
-            pool.map(template_worker, units),
+            (
+                res
+                for chunk_res in pool.map(template_worker, unit_chunks)
+                for res in chunk_res
+            ),
             total=len(units),
             desc="Raw templates" if raw_only else "Cleaned templates",
             smoothing=0,
@@ -330,21 +341,44 @@ def get_raw_denoised_template_single(
     device=None,
     batch_size=1024,
 ):
-    rg = np.random.default_rng(seed)
-    choices = slice(None)
-    if spike_times.shape[0] > max_spikes_per_unit:
-        choices = rg.choice(
-            spike_times.shape[0], max_spikes_per_unit, replace=False
-        )
-        choices.sort()
-    waveforms, skipped_idx = spikeio.read_waveforms(
-        spike_times[choices],
+    waveforms = read_unit_waveforms(
+        spike_times,
         raw_binary_file,
         len(geom),
+        max_spikes_per_unit=max_spikes_per_unit,
         trough_offset=trough_offset,
         spike_length_samples=spike_length_samples,
+        seed=seed,
     )
-    
+    return raw_denoised_template_from_waveforms(
+        waveforms,
+        do_tpca=do_tpca,
+        tpca=tpca,
+        do_temporal_decrease=do_temporal_decrease,
+        reducer=reducer,
+        spike_length_samples=spike_length_samples,
+        do_nn_denoise=do_nn_denoise,
+        denoiser_init_kwargs=denoiser_init_kwargs,
+        denoiser_weights_path=denoiser_weights_path,
+        device=device,
+        batch_size=batch_size,
+    )
+
+
+# %%
+def raw_denoised_template_from_waveforms(
+    waveforms,
+    do_tpca=True,
+    tpca=None,
+    do_temporal_decrease=True,
+    reducer=np.median,
+    spike_length_samples=121,
+    do_nn_denoise=False,
+    denoiser_init_kwargs={},
+    denoiser_weights_path=None,
+    device=None,
+    batch_size=1024,
+):
     if do_nn_denoise:
         N, T, C = waveforms.shape
         waveforms = waveforms.transpose(0, 2, 1).reshape(
@@ -416,6 +450,30 @@ def get_raw_template_single(
     spike_length_samples=121,
     seed=0,
 ):
+    waveforms = read_unit_waveforms(
+        spike_times,
+        raw_binary_file,
+        n_channels,
+        max_spikes_per_unit=max_spikes_per_unit,
+        trough_offset=trough_offset,
+        spike_length_samples=spike_length_samples,
+        seed=seed,
+    )
+
+    return reducer(waveforms, axis=0)
+
+
+# %%
+def read_unit_waveforms(
+    spike_times,
+    raw_binary_file,
+    n_channels,
+    max_spikes_per_unit=250,
+    trough_offset=42,
+    spike_length_samples=121,
+    seed=0,
+):
+    """Read a unit's waveforms, subsampled to at most max_spikes_per_unit"""
     choices = slice(None)
     if spike_times.shape[0] > max_spikes_per_unit:
         choices = np.random.default_rng(seed).choice(
@@ -431,7 +489,7 @@ def get_raw_template_single(
         spike_length_samples=spike_length_samples,
     )
 
-    return reducer(waveforms, axis=0)
+    return waveforms
 
 
 # %%
@@ -490,49 +548,61 @@ def denoised_weights_single(
 
 
 # %%
-def template_worker(unit):
+def template_worker(units):
     # parameters set by init below
     p = template_worker
 
-    in_unit = np.flatnonzero(p.spike_train[:, 1] == unit)
-
-    if p.raw_only:
-        raw_template = get_raw_template_single(
-            p.spike_train[in_unit, 0],
-            p.raw_binary_file,
-            p.geom.shape[0],
-            max_spikes_per_unit=p.max_spikes_per_unit,
-            reducer=p.reducer,
-            trough_offset=p.trough_offset,
-            spike_length_samples=p.spike_length_samples,
-            seed=p.rg.integers(np.iinfo(np.int64).max),
-        )
-        denoised_template = snr_by_channel = None
-    else:
-        (
-            raw_template,
-            denoised_template,
-            snr_by_channel,
-        ) = get_raw_denoised_template_single(
-            p.spike_train[in_unit, 0],
-            p.geom,
-            p.raw_binary_file,
-            do_tpca=p.do_tpca,
-            tpca=p.tpca,
-            do_temporal_decrease=p.do_temporal_decrease,
-            max_spikes_per_unit=p.max_spikes_per_unit,
-            seed=p.rg.integers(np.iinfo(np.int64).max),
-            reducer=p.reducer,
-            trough_offset=p.trough_offset,
-            spike_length_samples=p.spike_length_samples,
-            do_nn_denoise=p.do_nn_denoise,
-            denoiser_init_kwargs=p.denoiser_init_kwargs, 
-            denoiser_weights_path=p.denoiser_weights_path, 
-            device=p.device,
-            batch_size=p.batch_size,    
-        )
+    # double buffering: the next unit's waveforms are read in a thread
+    # while the current unit's template is computed
+    results = []
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        next_read = reader.submit(template_worker_read, units[0])
+        for i, unit in enumerate(units):
+            waveforms = next_read.result()
+            if i + 1 < len(units):
+                next_read = reader.submit(template_worker_read, units[i + 1])
+
+            if p.raw_only:
+                raw_template = p.reducer(waveforms, axis=0)
+                denoised_template = snr_by_channel = None
+            else:
+                (
+                    raw_template,
+                    denoised_template,
+                    snr_by_channel,
+                ) = raw_denoised_template_from_waveforms(
+                    waveforms,
+                    do_tpca=p.do_tpca,
+                    tpca=p.tpca,
+                    do_temporal_decrease=p.do_temporal_decrease,
+                    reducer=p.reducer,
+                    spike_length_samples=p.spike_length_samples,
+                    do_nn_denoise=p.do_nn_denoise,
+                    denoiser_init_kwargs=p.denoiser_init_kwargs,
+                    denoiser_weights_path=p.denoiser_weights_path,
+                    device=p.device,
+                    batch_size=p.batch_size,
+                )
+            results.append(
+                (unit, raw_template, denoised_template, snr_by_channel)
+            )
+
+    return results
 
-    return unit, raw_template, denoised_template, snr_by_channel
+
+# %%
+def template_worker_read(unit):
+    p = template_worker
+    start, end = np.searchsorted(p.sorted_labels, [unit, unit + 1])
+    return read_unit_waveforms(
+        p.sorted_times[start:end],
+        p.raw_binary_file,
+        p.geom.shape[0],
+        max_spikes_per_unit=p.max_spikes_per_unit,
+        trough_offset=p.trough_offset,
+        spike_length_samples=p.spike_length_samples,
+        seed=p.rg.integers(np.iinfo(np.int64).max),
+    )
 
 
 # %%
@@ -559,7 +629,11 @@ def template_worker_init(
     rank = id_queue.get()
     p = template_worker
     p.rg = np.random.default_rng(seed + rank)
-    p.spike_train = spike_train
+    # group the spike times by unit once, instead of scanning the whole
+    # spike train for each unit (stable, so times keep their order)
+    order = np.argsort(spike_train[:, 1], kind="stable")
+    p.sorted_labels = spike_train[order, 1]
+    p.sorted_times = spike_train[order, 0]
     p.geom = geom
     p.raw_binary_file = raw_binary_file
     p.do_tpca = do_tpca
@@ -25,6 +25,7 @@ def fit_tpca_bin(
     device=None,
     batch_size=1024,
     seed=0,
+    use_eigh=False,
 ):
     rg = np.random.default_rng(seed)
     tpca_channel_index = make_channel_index(
@@ -85,7 +86,9 @@ def fit_tpca_bin(
         del results
 
     # fit tpca or svd
-    if centered:
+    if centered and use_eigh:
+        tpca = fit_pca_eigh(tpca_waveforms, tpca_rank)
+    elif centered:
         tpca = PCA(tpca_rank).fit(tpca_waveforms)
     else:
         # TruncatedSVD is sklearn's uncentered PCA
@@ -99,6 +102,46 @@ def fit_tpca_bin(
     return tpca
 
 
+def fit_pca_eigh(X, n_components):
+    """PCA(n_components).fit(X), by eigendecomposition of the covariance
+
+    X is (N, T) with small T, like the waveforms for a TPCA, so the (T, T)
+    covariance is cheap to form (in float32) and decompose, where PCA would
+    run an SVD of all of X. The result is a fitted sklearn PCA, with the
+    same attributes and sign convention as PCA.fit. Components agree with
+    PCA up to float32 precision.
+    """
+    X = np.asarray(X, dtype=np.float32)
+    n_samples, n_features = X.shape
+    mean = X.mean(axis=0)
+    centered = X - mean
+    cov = centered.T @ centered
+    cov /= max(1, n_samples - 1)
+    evals, evecs = np.linalg.eigh(cov)
+    # decreasing order, and tiny negative eigenvalues are 0 variance
+    evals = np.maximum(evals[::-1], 0)
+    evecs = evecs[:, ::-1]
+    components = np.ascontiguousarray(evecs[:, :n_components].T)
+    # like sklearn's svd_flip: the largest entry of each component is positive
+    signs = np.sign(components[np.arange(n_components), np.abs(components).argmax(axis=1)])
+    components *= signs[:, None]
+
+    pca = PCA(n_components)
+    pca.mean_ = mean
+    pca.components_ = components
+    pca.n_components_ = n_components
+    pca.n_samples_ = n_samples
+    pca.n_features_in_ = n_features
+    pca.explained_variance_ = evals[:n_components]
+    pca.explained_variance_ratio_ = evals[:n_components] / evals.sum()
+    pca.singular_values_ = np.sqrt(evals[:n_components] * max(1, n_samples - 1))
+    if n_components < min(n_samples, n_features):
+        pca.noise_variance_ = evals[n_components:min(n_samples, n_features)].mean()
+    else:
+        pca.noise_variance_ = 0.0
+    return pca
+
+
 # %%
 def fit_tpca_bin_clustered(
     spike_times,
@@ -537,24 +580,37 @@ def get_pitch(geom):
 
 
 # %%
-def pitch_shift_templates(n_pitches_shift, geom, templates, fill_value=0.0):
+def pitch_shift_templates(
+    n_pitches_shift, geom, templates, fill_value=0.0, source_channels=None
+):
     if n_pitches_shift == 0:
         return templates
 
+    if source_channels is None:
+        source_channels = pitch_shift_channels(n_pitches_shift, geom)
+    has_source = source_channels >= 0
+    new_templates = np.full_like(templates, fill_value=fill_value)
+    new_templates[:, :, has_source] = templates[
+        :, :, source_channels[has_source]
+    ]
+
+    return new_templates
+
+
+def pitch_shift_channels(n_pitches_shift, geom):
+    """Channel whose data lands on each channel after a pitch shift
+
+    Returns an array with one entry per channel, holding the index of the
+    channel it loads from when shifting by n_pitches_shift pitches, or -1
+    if that position is off the probe.
+    """
     pitch = get_pitch(geom)
     # + or -? if the drift was +x, then we want to load from channel at +x
     shifted_geom = geom - [[0, n_pitches_shift * pitch]]
     geom_matching = (shifted_geom[:, None, :] == geom[None, :, :]).all(axis=2)
+    assert (geom_matching.sum(axis=1) <= 1).all()
 
-    new_templates = np.full_like(templates, fill_value=fill_value)
-    for shifted_ix, matched_orig in enumerate(
-        np.flatnonzero(gm) for gm in geom_matching
-    ):
-        if matched_orig.size:
-            assert matched_orig.size == 1
-            new_templates[:, :, shifted_ix] = templates[:, :, matched_orig[0]]
-
-    return new_templates
+    return np.where(geom_matching.any(axis=1), geom_matching.argmax(axis=1), -1)
 
 
 # %%
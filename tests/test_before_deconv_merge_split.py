@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from spike_psvae.before_deconv_merge_split import ks_bimodal_em
+
+
+def reference_ks_bimodal_em(unit_features, w):
+    """The numpy EM loop from ks_bimodal_pursuit_split, before numba"""
+    x = unit_features @ w
+    x_mean = x.mean()
+    s1 = x[x > x_mean].var()
+    s2 = x[x < x_mean].var()
+    mu1 = x[x > x_mean].mean()
+    mu2 = x[x < x_mean].mean()
+    p = (x > x_mean).mean()
+
+    logp = np.zeros((x.shape[0], 2), order="F")
+    logP = np.zeros(50)
+    for k in range(50):
+        if min(s1, s2) < 1e-6:
+            break
+
+        logp[:, 0] = np.log(s1) / 2 - ((x - mu1) ** 2) / (2 * s1) + np.log(p)
+        logp[:, 1] = (
+            np.log(s2) / 2 - ((x - mu2) ** 2) / (2 * s2) + np.log(1 - p)
+        )
+        lMax = logp.max(axis=1)
+        logp = logp - lMax[:, np.newaxis]
+        rs = np.exp(logp)
+        pval = np.log(np.sum(rs, axis=1)) + lMax
+        logP[k] = pval.mean()
+        rs /= np.sum(rs, axis=1)[:, np.newaxis]
+        if rs.sum(0).min() < 1e-6:
+            break
+
+        p = rs[:, 0].mean()
+        mu1 = np.dot(rs[:, 0], x) / np.sum(rs[:, 0])
+        mu2 = np.dot(rs[:, 1], x) / np.sum(rs[:, 1])
+        s1 = np.dot(rs[:, 0], (x - mu1) ** 2) / np.sum(rs[:, 0])
+        s2 = np.dot(rs[:, 1], (x - mu2) ** 2) / np.sum(rs[:, 1])
+        if min(s1, s2) < 1e-6:
+            break
+
+        if (k >= 10) and (k % 2 == 0):
+            StS = (
+                np.matmul(
+                    unit_features.T,
+                    unit_features
+                    * (rs[:, 0] / s1 + rs[:, 1] / s2)[:, np.newaxis],
+                )
+                / unit_features.shape[0]
+            )
+            StMu = (
+                np.dot(
+                    unit_features.T, rs[:, 0] * mu1 / s1 + rs[:, 1] * mu2 / s2
+                )
+                / unit_features.shape[0]
+            )
+            w = np.linalg.solve(StS.T, StMu)
+            w /= np.linalg.norm(w)
+            x = unit_features @ w
+
+    return logp
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_ks_bimodal_em_matches_reference(seed):
+    rg = np.random.default_rng(seed)
+    n_spikes = int(rg.integers(50, 3000))
+    rank = int(rg.integers(2, 6))
+    # two clusters, from well separated to overlapping, of uneven sizes
+    n_first = int(n_spikes * rg.uniform(0.05, 0.5))
+    offset = np.zeros(rank)
+    offset[0] = 3 * (seed % 4)
+    unit_features = np.r_[
+        rg.standard_normal((n_first, rank)) + offset,
+        rg.standard_normal((n_spikes - n_first, rank)),
+    ]
+    unit_features = rg.permutation(unit_features)
+    unit_features -= unit_features.mean(axis=0)
+    w = rg.standard_normal(rank)
+    w /= np.linalg.norm(w)
+
+    logp = ks_bimodal_em(unit_features, w)
+    expected = reference_ks_bimodal_em(unit_features, w)
+    # the Cholesky solve is slightly regularized and sums in another
+    # order, so only the assignments are exactly the same
+    assert np.allclose(logp, expected, atol=1e-6)
+    assert np.array_equal(
+        logp[:, 0] > logp[:, 1], expected[:, 0] > expected[:, 1]
+    )
+
+
+def test_ks_bimodal_em_collapsed_cluster():
+    # one side has no variance, so both stop before the first iteration
+    rg = np.random.default_rng(0)
+    unit_features = np.r_[np.ones((100, 3)), rg.standard_normal((10, 3)) - 5]
+    w = np.ones(3) / np.sqrt(3)
+
+    logp = ks_bimodal_em(unit_features, w)
+    expected = reference_ks_bimodal_em(unit_features, w)
+    assert np.array_equal(logp, expected)
+    assert not logp.any()
@@ -0,0 +1,456 @@
+import h5py
+import numpy as np
+import pytest
+
+from spike_psvae.drifty_deconv_uhd import (
+    append_to_h5_dataset,
+    grouped_median,
+    read_h5_dataset,
+    shift_superres_templates,
+    superres_spike_train,
+    update_spike_train_with_deconv_res,
+    write_h5_dataset,
+)
+
+# -- reference implementations
+# these are the straightforward per-unit loops which the vectorized
+# versions in drifty_deconv_uhd replaced, kept here to check against
+
+
+def reference_superres_spike_train(
+    spike_train,
+    z_abs,
+    x,
+    bin_size_um,
+    geom,
+    t_end=100,
+    units_spread=None,
+    n_spikes_max_recent=1000,
+    fs=30000,
+    dist_metric=None,
+    dist_metric_threshold=500,
+    adaptive_th_for_temp_computation=False,
+    outliers_tracking=None,
+):
+    spike_train_no_outliers = spike_train.copy()
+    if dist_metric is not None:
+        spike_train_no_outliers[dist_metric < dist_metric_threshold, 1] = -1
+    if adaptive_th_for_temp_computation:
+        spike_train_no_outliers[~outliers_tracking] = -1
+
+    superres_labels = np.full_like(spike_train_no_outliers[:, 1], -1)
+    n_spikes_per_bin = []
+    superres_label_to_bin_id = []
+    superres_label_to_orig_label = []
+    unit_max_channels = []
+    unit_labels = np.unique(
+        spike_train_no_outliers[spike_train_no_outliers[:, 1] >= 0, 1]
+    )
+    medians_at_computation = np.zeros(unit_labels.max() + 1)
+    cur_superres_label = 0
+    for u in unit_labels:
+        count_unit = np.logical_and(
+            spike_train_no_outliers[:, 0] < t_end * fs,
+            spike_train_no_outliers[:, 1] == u,
+        ).sum()
+        if count_unit > n_spikes_max_recent:
+            in_u = np.flatnonzero(
+                np.logical_and(
+                    spike_train_no_outliers[:, 0] < t_end * fs,
+                    spike_train_no_outliers[:, 1] == u,
+                )
+            )[-n_spikes_max_recent:]
+        else:
+            in_u = np.flatnonzero(spike_train_no_outliers[:, 1] == u)[
+                :n_spikes_max_recent
+            ]
+
+        centered_z = z_abs[in_u].copy()
+        medians_at_computation[u] = np.median(centered_z)
+        centered_z -= medians_at_computation[u]
+
+        bin_ids = (centered_z + bin_size_um / 2) // bin_size_um
+        occupied_bins, bin_counts = np.unique(bin_ids, return_counts=True)
+        if units_spread is not None:
+            in_spread = (
+                np.abs(occupied_bins)
+                <= (units_spread[u] + bin_size_um / 2) // bin_size_um
+            )
+            bin_counts = bin_counts[in_spread]
+            occupied_bins = occupied_bins[in_spread]
+        for j, bin_id in enumerate(occupied_bins):
+            in_bin = in_u[bin_ids == bin_id]
+            superres_labels[in_bin] = cur_superres_label
+            superres_label_to_bin_id.append(bin_id)
+            unit_max_channels.append(
+                np.sum(
+                    (geom - [np.median(x[in_bin]), np.median(z_abs[in_bin])])
+                    ** 2,
+                    axis=1,
+                ).argmin()
+            )
+            superres_label_to_orig_label.append(u)
+            n_spikes_per_bin.append(bin_counts[j])
+            cur_superres_label += 1
+
+    return (
+        superres_labels,
+        np.array(superres_label_to_bin_id),
+        np.array(superres_label_to_orig_label),
+        medians_at_computation,
+        np.array(unit_max_channels),
+        np.array(n_spikes_per_bin),
+    )
+
+
+def reference_update_spike_train_with_deconv_res(
+    start_sec,
+    end_sec,
+    spt_before,
+    spt_after,
+    x_before,
+    z_before,
+    localizations_after,
+    dist_metric_before,
+    dist_metric_after,
+    maxptps_before,
+    maxptps_after,
+    outliers_tracking,
+    outliers_tracking_chunk,
+    pfs=30000,
+    adaptive_th_for_temp_computation=False,
+):
+    x_after = localizations_after[:, 0]
+    z_after = localizations_after[:, 2]
+
+    idx_units_to_add = np.flatnonzero(
+        np.logical_and(
+            spt_before[:, 0] >= start_sec * pfs,
+            spt_before[:, 0] < end_sec * pfs,
+        )
+    )
+    units_to_add = np.setdiff1d(
+        np.unique(spt_before[idx_units_to_add, 1]), np.unique(spt_after[:, 1])
+    )
+
+    idx_before = np.flatnonzero(
+        np.logical_or(
+            spt_before[:, 0] < start_sec * pfs,
+            spt_before[:, 0] >= end_sec * pfs,
+        )
+    )
+    spt_after = np.concatenate((spt_before[idx_before], spt_after))
+    x_after = np.concatenate((x_before[idx_before], x_after))
+    z_after = np.concatenate((z_before[idx_before], z_after))
+    dist_metric_after = np.concatenate(
+        (dist_metric_before[idx_before], dist_metric_after)
+    )
+    maxptps_after = np.concatenate((maxptps_before[idx_before], maxptps_after))
+    if adaptive_th_for_temp_computation:
+        outliers_tracking_chunk = np.concatenate(
+            (outliers_tracking[idx_before], outliers_tracking_chunk)
+        )
+
+    for unit in units_to_add:
+        idx_unit = idx_units_to_add[spt_before[idx_units_to_add, 1] == unit]
+        spt_after = np.concatenate((spt_before[idx_unit], spt_after))
+        x_after = np.concatenate((x_before[idx_unit], x_after))
+        z_after = np.concatenate((z_before[idx_unit], z_after))
+        dist_metric_after = np.concatenate(
+            (dist_metric_before[idx_unit], dist_metric_after)
+        )
+        maxptps_after = np.concatenate(
+            (maxptps_before[idx_unit], maxptps_after)
+        )
+        if adaptive_th_for_temp_computation:
+            outliers_tracking_chunk = np.concatenate(
+                (outliers_tracking[idx_unit], outliers_tracking_chunk)
+            )
+
+    idx_sort_by_time = spt_after[:, 0].argsort()
+    x_after = x_after[idx_sort_by_time]
+    z_after = z_after[idx_sort_by_time]
+    dist_metric_after = dist_metric_after[idx_sort_by_time]
+    maxptps_after = maxptps_after[idx_sort_by_time]
+    spt_after = spt_after[idx_sort_by_time]
+    if adaptive_th_for_temp_computation:
+        outliers_tracking_chunk = outliers_tracking_chunk[idx_sort_by_time]
+
+    return (
+        spt_after.astype("int"),
+        x_after,
+        z_after,
+        dist_metric_after,
+        maxptps_after,
+        outliers_tracking_chunk,
+    )
+
+
+# -- tests
+
+
+def test_grouped_median():
+    rg = np.random.default_rng(0)
+    for n_groups in (1, 2, 7, 50):
+        # every group is non-empty, with both odd and even counts
+        groups = np.concatenate(
+            [np.arange(n_groups), rg.integers(0, n_groups, size=5 * n_groups)]
+        )
+        groups = rg.permutation(groups)
+        values = rg.normal(size=groups.size)
+        # repeated values
+        values[::3] = np.round(values[::3])
+        medians = grouped_median(values, groups, n_groups)
+        expected = [np.median(values[groups == g]) for g in range(n_groups)]
+        assert np.array_equal(medians, expected)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_superres_spike_train_matches_reference(seed):
+    rg = np.random.default_rng(seed)
+    geom = np.c_[
+        np.tile([0, 16, 32, 48], 50), np.repeat(np.arange(50) * 20, 4)
+    ].astype(float)
+    n_spikes = rg.integers(200, 5000)
+    n_units = rg.integers(2, 40)
+
+    # unsorted times on odd seeds, -1 labels, and a unit with no spikes
+    times = rg.integers(0, 200 * 30000, size=n_spikes)
+    if seed % 2 == 0:
+        times = np.sort(times)
+    labels = rg.integers(-1, n_units, size=n_spikes)
+    labels[labels == n_units // 2] = -1
+    labels[0] = n_units - 1
+    spike_train = np.c_[times, labels]
+    z = rg.normal(500, 40, size=n_spikes)
+    if seed % 3 == 0:
+        z = z.astype(np.float32)
+    x = rg.uniform(0, 48, size=n_spikes)
+
+    kwargs = dict(
+        n_spikes_max_recent=int(rg.integers(5, 400)),
+        t_end=int(rg.integers(10, 150)),
+    )
+    if seed % 2:
+        # some units lose some or all of their bins
+        kwargs["units_spread"] = rg.uniform(0, 60, size=n_units)
+    if seed % 4 == 1:
+        kwargs["dist_metric"] = rg.uniform(0, 1000, size=n_spikes)
+    if seed % 5 == 2:
+        kwargs["adaptive_th_for_temp_computation"] = True
+        kwargs["outliers_tracking"] = rg.random(n_spikes) > 0.2
+
+    result = superres_spike_train(spike_train, z, x, 5.0, geom, **kwargs)
+    expected = reference_superres_spike_train(
+        spike_train, z, x, 5.0, geom, **kwargs
+    )
+    for res, exp in zip(result, expected):
+        assert res.shape == exp.shape
+        assert np.array_equal(res, exp)
+
+
+def test_superres_spike_train_no_spikes_in_spread():
+    rg = np.random.default_rng(0)
+    geom = np.c_[np.zeros(4), np.arange(4) * 20.0]
+    spike_train = np.c_[np.arange(50), rg.integers(-1, 3, size=50)]
+    z = rg.normal(30, 5, size=50)
+    x = np.zeros(50)
+    # a negative spread keeps no bins at all
+    kwargs = dict(units_spread=np.full(3, -10.0))
+
+    result = superres_spike_train(spike_train, z, x, 5.0, geom, **kwargs)
+    expected = reference_superres_spike_train(
+        spike_train, z, x, 5.0, geom, **kwargs
+    )
+    assert (result[0] == -1).all()
+    for res, exp in zip(result, expected):
+        assert res.shape == exp.shape
+        assert np.array_equal(res, exp)
+
+
+def update_case(
+    rg, n_before, n_chunk, n_units, sort_before, sort_chunk, all_units_in_chunk
+):
+    """Random inputs for update_spike_train_with_deconv_res"""
+    pfs = 30000
+    start_sec, end_sec = np.sort(rg.integers(0, 100, size=2))
+    end_sec += 1
+    # coarse times, so that there are ties within and across the inputs
+    times_before = rg.integers(0, 100 * pfs // 1000, size=n_before) * 1000
+    if sort_before:
+        times_before = np.sort(times_before)
+    spt_before = np.c_[times_before, rg.integers(-1, n_units, size=n_before)]
+    in_window = (times_before >= start_sec * pfs) & (
+        times_before < end_sec * pfs
+    )
+
+    times_chunk = (
+        rg.integers(
+            start_sec * pfs // 1000, end_sec * pfs // 1000, size=n_chunk
+        )
+        * 1000
+    )
+    labels_chunk = rg.integers(0, n_units, size=n_chunk)
+    if all_units_in_chunk:
+        # every unit of the window is deconvolved in the chunk
+        window_units = np.unique(spt_before[in_window, 1])
+        times_chunk = np.r_[
+            times_chunk,
+            rg.integers(
+                start_sec * pfs, end_sec * pfs, size=window_units.size
+            ),
+        ]
+        labels_chunk = np.r_[labels_chunk, window_units]
+    if sort_chunk:
+        order = np.argsort(times_chunk, kind="stable")
+        times_chunk = times_chunk[order]
+        labels_chunk = labels_chunk[order]
+    spt_chunk = np.c_[times_chunk, labels_chunk]
+    n_chunk = len(spt_chunk)
+
+    return (
+        start_sec,
+        end_sec,
+        spt_before,
+        spt_chunk,
+        # unique values, so that the canonical order below is well defined
+        rg.permutation(n_before).astype(float),
+        rg.normal(size=n_before),
+        np.c_[
+            n_before + rg.permutation(n_chunk), rg.normal(size=(n_chunk, 3))
+        ],
+        rg.normal(size=n_before),
+        rg.normal(size=n_chunk),
+        rg.normal(size=n_before),
+        rg.normal(size=n_chunk),
+        rg.random(n_before) > 0.5,
+        rg.random(n_chunk) > 0.5,
+        pfs,
+    )
+
+
+@pytest.mark.parametrize("seed", range(40))
+@pytest.mark.parametrize("adaptive", [False, True])
+@pytest.mark.parametrize(
+    "sort_before,sort_chunk,all_units_in_chunk",
+    [
+        # spikes fit between before and after the window, no sorting
+        (True, True, True),
+        # units missing from the chunk, merged in linear time
+        (True, True, False),
+        # unsorted inputs, argsorted
+        (False, True, False),
+        (True, False, True),
+        (False, False, False),
+    ],
+)
+def test_update_spike_train_with_deconv_res_matches_reference(
+    seed, adaptive, sort_before, sort_chunk, all_units_in_chunk
+):
+    rg = np.random.default_rng(seed)
+    n_before = int(rg.integers(0, 2000)) if seed % 10 else 0
+    n_chunk = int(rg.integers(0, 300)) if seed % 7 else 0
+    n_units = int(rg.integers(1, 100))
+    args = update_case(
+        rg,
+        n_before,
+        n_chunk,
+        n_units,
+        sort_before,
+        sort_chunk,
+        all_units_in_chunk,
+    )
+
+    result = update_spike_train_with_deconv_res(*args, adaptive)
+    expected = reference_update_spike_train_with_deconv_res(*args, adaptive)
+
+    # the result is time sorted. the reference argsort does not keep
+    # simultaneous spikes in a fixed order, so compare in the order of
+    # (time, x), x being unique
+    spt, x = result[:2]
+    assert spt.dtype == np.int64
+    assert (np.diff(spt[:, 0]) >= 0).all()
+    order = np.lexsort((x, spt[:, 0]))
+    expected_order = np.lexsort((expected[1], expected[0][:, 0]))
+    if not adaptive:
+        # outliers_tracking_chunk is handed back untouched
+        assert result[5] is args[-2]
+        result, expected = result[:5], expected[:5]
+    # full_deconv_with_update reuses the chunk input buffers
+    for res in result:
+        for chunk_input in args[3], args[6], args[8], args[10], args[12]:
+            assert not np.shares_memory(res, chunk_input)
+    for i, (res, exp) in enumerate(zip(result, expected)):
+        exp = exp[expected_order]
+        if i in (3, 4):
+            # dist_metric and maxptps come back in float32
+            assert res.dtype == np.float32
+            exp = exp.astype(np.float32)
+        assert np.array_equal(res[order], exp)
+
+
+def test_append_to_h5_dataset_empty_first_append(tmp_path):
+    rg = np.random.default_rng(0)
+    appends = [np.empty((0, 2), dtype=np.int64)] + [
+        rg.integers(0, 1000, size=(n, 2)) for n in (3, 0, 500, 7)
+    ]
+    with h5py.File(tmp_path / "res.h5", "w") as h5:
+        for data in appends:
+            append_to_h5_dataset(h5, "spike_train", data)
+            append_to_h5_dataset(h5, "offsets", [len(data)], chunk_rows=256)
+        # chunks are sized from the byte budget, not the (empty) first append
+        assert h5["spike_train"].chunks == (1024 * 1024 // 16, 2)
+        assert h5["offsets"].chunks == (256,)
+        assert np.array_equal(h5["spike_train"][:], np.concatenate(appends))
+        assert np.array_equal(h5["offsets"][:], [len(a) for a in appends])
+
+
+def test_read_h5_dataset_buffers(tmp_path):
+    rg = np.random.default_rng(0)
+    buffers = {}
+    with h5py.File(tmp_path / "res.h5", "w") as h5:
+        for n in (100, 50, 0, 200, 120):
+            data = rg.normal(size=(n, 3)).astype(np.float32)
+            if "x" in h5:
+                del h5["x"]
+            h5.create_dataset("x", data=data)
+            out = read_h5_dataset(h5["x"], buffers)
+            assert out.dtype == data.dtype
+            assert np.array_equal(out, data)
+            assert not n or np.shares_memory(out, buffers["/x"])
+            assert np.array_equal(read_h5_dataset(h5["x"]), data)
+
+
+def test_write_h5_dataset_roundtrip(tmp_path):
+    rg = np.random.default_rng(0)
+    arrays = dict(
+        templates=rg.normal(size=(100, 5, 7)).astype(np.float32),
+        bin_size_um=np.float64(2.0),
+        empty=np.empty((0, 2), dtype=np.int64),
+        # not contiguous
+        spike_train=rg.integers(0, 9, size=(50, 2))[:, ::-1],
+        flags=rg.random(10) > 0.5,
+    )
+    with h5py.File(tmp_path / "res.h5", "w") as h5:
+        for name, data in arrays.items():
+            write_h5_dataset(h5, name, data)
+        for name, data in arrays.items():
+            assert h5[name].dtype == data.dtype
+            assert np.array_equal(h5[name][()], data)
+
+
+def test_shift_superres_templates_no_shift_copies():
+    rg = np.random.default_rng(0)
+    geom = np.c_[
+        np.tile([0, 16, 32, 48], 10), np.repeat(np.arange(10) * 20, 4)
+    ].astype(float)
+    labels = np.repeat(np.arange(3), 4)
+    bin_ids = np.tile(np.arange(-2, 2), 3).astype(np.int32)
+    templates = rg.normal(size=(12, 11, 40)).astype(np.float32)
+    medians = rg.normal(size=3)
+
+    shifted = shift_superres_templates(
+        templates, bin_ids, labels, 2.0, geom, 0.0, medians, medians
+    )
+    assert np.array_equal(shifted, templates)
+    assert not np.shares_memory(shifted, templates)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from sklearn.decomposition import PCA
+
+from spike_psvae.waveform_utils import fit_pca_eigh
+
+
+@pytest.mark.parametrize("n_components", [1, 5, 8])
+def test_fit_pca_eigh_matches_pca(n_components):
+    rg = np.random.default_rng(n_components)
+    # low rank waveforms plus noise, with decaying component scales
+    n_samples, n_features = 3000, 41
+    basis = rg.standard_normal((8, n_features))
+    scales = 2.0 ** -np.arange(8)
+    X = (rg.standard_normal((n_samples, 8)) * 10 * scales) @ basis
+    X += 0.1 * rg.standard_normal((n_samples, n_features)) + 3.0
+    X = X.astype(np.float32)
+
+    pca = PCA(n_components, svd_solver="full").fit(X)
+    eigh_pca = fit_pca_eigh(X, n_components)
+
+    for attr in (
+        "mean_",
+        "components_",
+        "explained_variance_",
+        "explained_variance_ratio_",
+        "singular_values_",
+        "noise_variance_",
+    ):
+        assert np.allclose(
+            getattr(eigh_pca, attr), getattr(pca, attr), rtol=1e-3, atol=1e-4
+        ), attr
+    assert eigh_pca.n_components_ == pca.n_components_
+    assert eigh_pca.n_features_in_ == pca.n_features_in_
+
+    projs = eigh_pca.transform(X)
+    assert np.allclose(projs, pca.transform(X), rtol=1e-3, atol=1e-3)
+    assert np.allclose(
+        eigh_pca.inverse_transform(projs),
+        pca.inverse_transform(pca.transform(X)),
+        rtol=1e-3,
+        atol=1e-3,
+    )
+    assert np.allclose(
+        eigh_pca.get_covariance(), pca.get_covariance(), rtol=1e-3, atol=1e-3
+    )